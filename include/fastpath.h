@@ -0,0 +1,63 @@
+#ifndef FASTPATH_H
+#define FASTPATH_H
+
+#include <stdint.h>
+#include <stddef.h>
+
+/* number of FDB mirror entries, a power of 2 */
+#define FASTPATH_FDB_SIZE 4096
+
+/*
+ * Native forwarding of known unicast frames. The switch logic stays in
+ * Python, which pushes down a mirror of its FDB (MAC + VLAN -> port) and the
+ * VLAN and STP state of every port. A received frame is forwarded in C when
+ * its source is already learnt on the ingress port and its destination is in
+ * the mirror; everything else (BPDUs, ARP, multicast, unknown destinations,
+ * new or moved sources) is punted to Python.
+ */
+
+struct fastpath_stats {
+	uint64_t forwarded;	/* frames sent by the fast path */
+	uint64_t dropped;	/* frames the switch logic drops */
+	uint64_t punted;	/* frames given to Python */
+};
+
+/* enable the fast path; port_vlans[i] is the VLAN of access port i, or -1 for
+ * a trunk. Every port starts designated (STP state 1).
+ * Returns 0, or -errno */
+extern int fastpath_enable(const int *port_vlans, int num_ports);
+
+/* return a true value if the fast path is enabled */
+extern int fastpath_enabled(void);
+
+/* add (or move) a MAC of a VLAN. Returns 0, or -ENOSPC if the mirror is full */
+extern int fastpath_fdb_set(const uint8_t *mac, int vlan, int port);
+
+/* remove a MAC of a VLAN */
+extern void fastpath_fdb_remove(const uint8_t *mac, int vlan);
+
+/* store in keys (VLAN << 48 | MAC) up to max MACs the fast path forwarded
+ * frames from since the last call, so that Python can refresh them.
+ * Returns the number of keys stored */
+extern int fastpath_fdb_hits(uint64_t *keys, int max);
+
+/* make port the logical port of a link aggregation group and set its active
+ * members (the ports frames are spread over, by a hash of the MACs and VLAN,
+ * and of the IPv4 addresses and TCP/UDP ports if l3l4 is true). Frames
+ * received on a member are seen as received on port. No active members
+ * drops the frames sent to the group. Returns 0, or -EINVAL */
+extern int fastpath_set_lag(int port, const int *members, int count, int l3l4);
+
+/* set the STP state of a port (-1: blocked) */
+extern void fastpath_set_port_state(int port, int state);
+
+/* forward the frames of a received batch that hit the mirror. The punted
+ * frames are moved, in order, to the front of the arrays (frames, ifaces and
+ * lengths are permuted, never lost).
+ * Returns the number of punted frames */
+extern int fastpath_process(char **frames, int *ifaces, size_t *lengths,
+			    int count);
+
+extern void fastpath_get_stats(struct fastpath_stats *stats);
+
+#endif
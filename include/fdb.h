@@ -0,0 +1,53 @@
+#ifndef FDB_H
+#define FDB_H
+
+#include <stdint.h>
+
+/* number of MAC table entries, a power of 2 */
+#define FDB_SIZE 4096
+
+/*
+ * Forwarding state shared by processes forked after shared_state_create: the
+ * MAC table and the STP state of every port. It has a single writer, readers
+ * never take a lock (each entry is guarded by a sequence counter).
+ */
+
+/* create the shared state; must be called before forking the readers.
+ * Returns 0, or -errno */
+extern int shared_state_create(int num_ports);
+
+/* The MAC table is keyed by VLAN << 48 | MAC, the MAC read as a big endian
+ * 48 bit integer: a MAC is learnt independently in every VLAN */
+
+/* return the port a key was learnt on, or -1 if it is unknown */
+extern int fdb_lookup(uint64_t key);
+
+/* fdb_lookup for a source key: a known key is also marked as seen now, so
+ * that it doesn't age out. Readers may call it */
+extern int fdb_touch(uint64_t key);
+
+/* learn (or move) a key on a port. Writer only. When the table is full, the
+ * least recently seen key makes room.
+ * Returns 1 if a key was forgotten to make room, else 0 */
+extern int fdb_learn(uint64_t key, int port);
+
+/* forget the keys of a VLAN learnt on a port; -1 matches any VLAN or port.
+ * Writer only. Returns the number of keys forgotten */
+extern int fdb_flush(int vlan, int port);
+
+/* forget the keys not seen for aging_time seconds. Writer only.
+ * Returns the number of keys forgotten */
+extern int fdb_expire(unsigned int aging_time);
+
+/* return a counter bumped every time a key moves to another port or is
+ * forgotten (flushed, aged out or evicted) */
+extern unsigned int fdb_generation(void);
+
+/* get and set the STP state of a port; setting is for the writer only */
+extern int stp_get_state(int port);
+extern void stp_set_state(int port, int state);
+
+/* return a counter bumped by every STP state change */
+extern unsigned int stp_generation(void);
+
+#endif
@@ -6,26 +6,170 @@
 #include <stdio.h>
 #include <stdlib.h>
 
+/* Frame buffers are sized from the MTU of the interfaces (see
+ * get_max_frame_len); MAX_PACKET_LEN is the smallest size, enough for the
+ * standard 1500 bytes MTU */
 #define MAX_PACKET_LEN 1600
-#define SWITCH_NUM_INTERFACES 4
+#define MAX_BATCH_LEN 64
 
+/* What a frame adds to the MTU: the Ethernet header, and the VLAN tag the
+ * switch may push. The kernel lets a frame tagged with VLAN_TPID (not
+ * 802.1Q) be at most MTU + ETH_HEADER_LEN long, tag included */
+#define ETH_HEADER_LEN 14
+#define VLAN_TAG_LEN 4
+
+/* TPID of the VLAN tags used by the switch */
+#define VLAN_TPID 0x8200
+
+#define RX_FILTER_MAX_ETHERTYPES 32
+
+/* Receive and transmit backends, or'ed together for init_backend */
+#define RX_BACKEND_SOCKET 0 /* read()/recvmmsg() on the packet sockets */
+#define RX_BACKEND_RING 1   /* TPACKET_V3 mmap ring per interface */
+#define TX_BACKEND_SOCKET 0 /* write()/sendmmsg() on the packet sockets */
+#define TX_BACKEND_RING 2   /* PACKET_TX_RING per interface */
+
+#define RX_RING_BLOCK_SIZE (1 << 16)
+#define RX_RING_BLOCK_NR 64
+#define RX_RING_FRAME_SIZE 2048
+#define RX_RING_BLOCK_TIMEOUT 10 /* ms before a partially filled block is retired */
+
+#define TX_RING_BLOCK_SIZE (1 << 16)
+#define TX_RING_BLOCK_NR 16
+#define TX_RING_FRAME_SIZE 2048
+
+/* What to drop when a frame is sent to a full egress queue */
+#define EGRESS_DROP_TAIL 0 /* the new frame */
+#define EGRESS_DROP_HEAD 1 /* the oldest frame of the queue */
+
+/* Frames of an interface dropped for their size */
+struct link_stats {
+	uint64_t rx_oversize;	/* received frames larger than the buffers */
+	uint64_t tx_oversize;	/* frames to send larger than the MTU allows */
+	uint64_t rx_errors;	/* receive errors, e.g. ENETDOWN while the link is down */
+};
+
+/* Counters of the egress queue of an interface */
+struct egress_stats {
+	uint64_t enqueued;	/* frames accepted in the queue */
+	uint64_t sent;		/* frames written by the transmit thread */
+	uint64_t dropped;	/* frames dropped because the queue was full */
+	uint64_t errors;	/* frames refused by the kernel */
+	uint32_t depth;		/* frames waiting now */
+	uint32_t max_depth;	/* highest depth seen */
+};
+
+/*
+ * @brief Sends a frame on an interface. With TX_BACKEND_RING the frame is
+ * queued in the TX ring and the ring is flushed. With egress queues (see
+ * egress_queues_start) the frame is only copied in the queue of the interface.
+ *
+ * Returns: the number of bytes sent (or queued), or -errno if the write failed
+ * (-ENOBUFS if the TX ring or the egress queue is full, -EMSGSIZE if the frame
+ * is too large for the MTU of the interface).
+ */
 int send_to_link(int interface, char *frame_data, size_t length);
 
+/*
+ * @brief Sends a frame made of two fragments, head followed by tail, with a
+ * single sendmsg. Used to push or pop a VLAN tag by only rewriting the first
+ * bytes of the frame, whatever its size.
+ *
+ * Returns: the number of bytes sent, or -errno if the send failed.
+ */
+int send_to_link_iov(int interface, char *head, size_t head_len, char *tail,
+		     size_t tail_len);
+
+/*
+ * @brief Sends count frames, possibly on different interfaces. Frames that
+ * leave on the same interface are sent in order with as few sendmmsg calls as
+ * possible. Each frame is made of a head and an optional tail fragment.
+ *
+ * @param ifaces - the interface of each frame
+ * @param heads - pointers to the first fragment of each frame
+ * @param head_lens - the length of each first fragment
+ * @param tails - pointers to the second fragment of each frame; may be NULL
+ * @param tail_lens - the length of each second fragment; 0 for none
+ * Returns: the number of frames sent. Frames too large for the MTU of their
+ * interface are dropped, counted in its link_stats. With TX_BACKEND_RING,
+ * frames that find their TX ring full are dropped and not counted; each ring
+ * is flushed once.
+ * With egress queues, the number of frames queued.
+ */
+int send_batch(int *ifaces, char **heads, size_t *head_lens, char **tails,
+	       size_t *tail_lens, int count);
+
 /*
  * @brief Receives a packet. Blocking function, blocks if there is no packet to
- * be received.
+ * be received. The interfaces are waited on with epoll and the ready ones are
+ * served in turn (round-robin).
  *
  * @param frame_data - region of memory in which the data will be copied; should
- *        have at least MAX_PACKET_LEN bytes allocated 
+ *        have at least get_max_frame_len() bytes allocated
  * @param length - will be set to the total number of bytes received.
  * Returns: the interface it has been received from.
  */
 int recv_from_any_link(char *frame_data, size_t *length);
 
+/*
+ * @brief Receives a batch of packets. Blocks until at least one packet is
+ * available, then drains the ready interfaces in turn with recvmmsg, each one
+ * getting an equal share of the batch.
+ *
+ * @param frames - max_frames pointers to regions of frame_size bytes each;
+ *        frame i is copied at frames[i]
+ * @param ifaces - will be set to the interface each frame was received from
+ * @param lengths - will be set to the number of bytes of each frame
+ * @param max_frames - capacity of the batch, at most MAX_BATCH_LEN
+ * Returns: the number of frames received. Frames larger than frame_size are
+ * dropped, counted in the link_stats of their interface. With the fast path
+ * enabled (see fastpath.h), only the frames it punts are returned, in the
+ * first entries of frames, ifaces and lengths; frames is reordered
+ * accordingly.
+ */
+int recv_batch(char **frames, size_t frame_size, int *ifaces, size_t *lengths,
+	       int max_frames);
+
+/*
+ * @brief Same as recv_batch, but only for one interface and without blocking.
+ * Meant for callers that wait on the interfaces themselves (see
+ * get_interface_fd).
+ *
+ * Returns: the number of frames received, 0 if none was queued.
+ */
+int recv_batch_from_link(int interface, char **frames, size_t frame_size,
+			 size_t *lengths, int max_frames);
+
+/* Returns the file descriptor of the socket of an interface, e.g. to wait on
+ * it from an event loop */
+int get_interface_fd(int interface);
+
+
+/* Sets the MTU of an interface, by name. Meant to be called before
+ * init_backend, which reads the MTUs. Returns: 0, or -errno on failure */
+int set_interface_mtu(const char *name, int mtu);
+
+/* Returns the MTU of an interface, as read by init_backend */
+int get_interface_mtu(int interface);
+
+/* Returns the size of the frame buffers: the largest frame of any interface,
+ * its MTU plus the Ethernet header and a VLAN tag */
+size_t get_max_frame_len(void);
 
-/* Returns the name of an itnerface */
+/*
+ * @brief Copies the counters of the frames of an interface dropped for their
+ * size in stats.
+ * Returns: 0, or -1 if there is no such interface.
+ */
+int get_link_stats(int interface, struct link_stats *stats);
+
+/* Returns the name of an itnerface, as given to init */
 char *get_interface_name(int interface);
 
+/* Returns 1 if the link of an interface is up (the interface is up and has a
+ * carrier), 0 if not, or -errno */
+int get_link_up(int interface);
+
 char *get_interface_ip(int interface);
 
 /**
@@ -45,8 +189,99 @@ void get_interface_mac(int interface, uint8_t *mac);
  */
 int hwaddr_aton(const char *txt, uint8_t *addr);
 
+/*
+ * @brief Receives a batch of packets from the TPACKET_V3 rings
+ * (RX_BACKEND_RING). Blocks until at least one packet is available. No data is
+ * copied: frames[i] points inside the ring of interface ifaces[i] and stays
+ * valid until ring_release() is called. Every frame must be released before
+ * the next call, or it will not block. With the fast path enabled, only the
+ * frames it punts are returned.
+ *
+ * Returns: the number of frames received.
+ */
+int ring_recv_batch(char **frames, int *ifaces, size_t *lengths, int max_frames);
+
+/*
+ * @brief Same as ring_recv_batch, but only for one interface and without
+ * blocking.
+ *
+ * Returns: the number of frames received, 0 if none was ready.
+ */
+int ring_recv_from_link(int interface, char **frames, size_t *lengths,
+			int max_frames);
+
+/* Gives the blocks walked by ring_recv_batch back to the kernel */
+void ring_release(void);
+
+/*
+ * @brief Gets the memory region of the receive ring of an interface.
+ * Returns: 0 on success, -1 if the interface has no ring.
+ */
+int get_rx_ring(int interface, char **map, size_t *size);
+
+/*
+ * @brief Opens the interfaces in argv (any number of them) with the given
+ * backends, a RX_BACKEND_* value or'ed with a TX_BACKEND_* value. With
+ * RX_BACKEND_RING, frames must be received with ring_recv_batch. With
+ * TX_BACKEND_RING, every send function goes through the TX rings.
+ *
+ * Returns: the number of interfaces.
+ */
+int init_backend(int argc, char *argv[], int backend);
+
+/* Same as init_backend with RX_BACKEND_SOCKET */
 int init(int argc, char *argv[]);
 
+/*
+ * @brief Attaches a classic BPF filter to the socket of every interface, so
+ * that the frames the switch doesn't handle are dropped in the kernel. The
+ * frames kept are the BPDUs (01:80:c2:00:00:00) and the frames whose
+ * ethertype, or the ethertype after a VLAN_TPID tag, is one of ethertypes.
+ * With count 0 no filter is attached. With ignore_outgoing, frames sent on an
+ * interface (by any socket of the host) are not received on it.
+ *
+ * Returns: 0, or -errno on failure (-EINVAL if count is above
+ * RX_FILTER_MAX_ETHERTYPES).
+ */
+int set_rx_filter(const uint16_t *ethertypes, int count, int ignore_outgoing);
+
+/*
+ * @brief Makes the sockets of every interface join a PACKET_FANOUT group in
+ * hash mode, so that the frames of an interface are spread over every process
+ * that joined with the same group_id, each flow always going to the same one.
+ * Interface i uses the group group_id + i. Frames sent by the other members
+ * are not received.
+ *
+ * Returns: 0, or -errno if a socket could not join.
+ */
+int join_fanout(int group_id);
+
+/*
+ * @brief Gives every interface a queue of up to capacity frames and a
+ * transmit thread. From then on the send functions only copy the frames in
+ * the queues and never block; the threads write them with non-blocking
+ * sends, so a slow interface doesn't hold back the others. When a queue is
+ * full, policy (EGRESS_DROP_TAIL or EGRESS_DROP_HEAD) tells which frame is
+ * dropped. Must be called after init_backend.
+ *
+ * Returns: 0, or -errno on failure.
+ */
+int egress_queues_start(unsigned int capacity, int policy);
+
+/*
+ * @brief Copies the counters of the egress queue of an interface in stats.
+ * Returns: 0, or -1 if there are no egress queues.
+ */
+int get_egress_stats(int interface, struct egress_stats *stats);
+
+/*
+ * @brief Drops every frame received on the interfaces, for a process that
+ * only sends.
+ *
+ * Returns: 0, or -errno on failure.
+ */
+int disable_rx(void);
+
 #define DIE(condition, message, ...) \
 	do { \
 		if ((condition)) { \
@@ -0,0 +1,359 @@
+#include "fastpath.h"
+#include "lib.h"
+#include <string.h>
+#include <errno.h>
+
+/* What the switch does with a frame */
+enum {
+	FP_PUNT,	/* let Python decide */
+	FP_DROP,
+	FP_FORWARD,	/* send as is */
+	FP_TAG,		/* access -> trunk: push the VLAN tag */
+	FP_UNTAG,	/* trunk -> access: pop the VLAN tag */
+};
+
+struct fastpath_entry {
+	uint8_t used;
+	uint8_t mac[6];
+	uint8_t hit;	/* a frame from the MAC was forwarded since the last
+			 * fastpath_fdb_hits */
+	int16_t vlan;
+	int16_t port;
+};
+
+static int enabled;
+static struct fastpath_entry fdb[FASTPATH_FDB_SIZE];
+static int *port_vlans;
+static int8_t *port_states;
+/* logical port of every port: itself, or the first member of its LAG */
+static int *port_lags;
+/* active members of every logical port, num_ports slots each */
+static int *lag_members;
+static int *lag_counts;
+static uint8_t *lag_l3l4;
+static int num_ports;
+static struct fastpath_stats stats;
+
+int fastpath_enable(const int *vlans, int count)
+{
+	port_vlans = calloc(count, sizeof(*port_vlans));
+	port_states = calloc(count, sizeof(*port_states));
+	port_lags = calloc(count, sizeof(*port_lags));
+	lag_members = calloc(count * count, sizeof(*lag_members));
+	lag_counts = calloc(count, sizeof(*lag_counts));
+	lag_l3l4 = calloc(count, sizeof(*lag_l3l4));
+	if (!port_vlans || !port_states || !port_lags || !lag_members ||
+	    !lag_counts || !lag_l3l4)
+		return -ENOMEM;
+
+	for (int i = 0; i < count; i++) {
+		port_vlans[i] = vlans[i];
+		port_states[i] = 1;
+		port_lags[i] = i;
+		lag_members[i * count] = i;
+		lag_counts[i] = 1;
+	}
+	num_ports = count;
+	enabled = 1;
+	return 0;
+}
+
+int fastpath_enabled(void)
+{
+	return enabled;
+}
+
+static unsigned int fastpath_hash(const uint8_t *mac, int vlan)
+{
+	uint32_t h = (mac[0] << 8 | mac[1]) ^ (mac[2] << 24 | mac[3] << 16 |
+					      mac[4] << 8 | mac[5]) ^ vlan << 20;
+
+	return (h * 2654435761u) >> 20 & (FASTPATH_FDB_SIZE - 1);
+}
+
+/* Returns the entry of a MAC and VLAN, or the free entry where it goes */
+static struct fastpath_entry *fdb_slot(const uint8_t *mac, int vlan)
+{
+	unsigned int idx = fastpath_hash(mac, vlan);
+	struct fastpath_entry *e;
+
+	for (int n = 0; n < FASTPATH_FDB_SIZE; n++) {
+		e = &fdb[idx];
+		if (!e->used || (e->vlan == vlan && !memcmp(e->mac, mac, 6)))
+			return e;
+		idx = (idx + 1) & (FASTPATH_FDB_SIZE - 1);
+	}
+
+	return NULL;
+}
+
+static int fdb_find(const uint8_t *mac, int vlan)
+{
+	struct fastpath_entry *e = fdb_slot(mac, vlan);
+
+	return e && e->used ? e->port : -1;
+}
+
+int fastpath_fdb_set(const uint8_t *mac, int vlan, int port)
+{
+	struct fastpath_entry *e = fdb_slot(mac, vlan);
+
+	if (!e)
+		return -ENOSPC;
+
+	e->used = 1;
+	e->hit = 0;
+	memcpy(e->mac, mac, 6);
+	e->vlan = vlan;
+	e->port = port;
+	return 0;
+}
+
+/* Empties an entry and moves back the entries after it that were pushed
+ * further by linear probing, so that no lookup stops too early */
+static void fdb_remove(unsigned int hole)
+{
+	unsigned int idx = hole, home;
+
+	fdb[hole].used = 0;
+	while (1) {
+		idx = (idx + 1) & (FASTPATH_FDB_SIZE - 1);
+		if (!fdb[idx].used)
+			return;
+
+		home = fastpath_hash(fdb[idx].mac, fdb[idx].vlan);
+		/* The entry can move to the hole if its home slot is not
+		 * between the hole and where it is */
+		if (((idx - home) & (FASTPATH_FDB_SIZE - 1)) >=
+		    ((idx - hole) & (FASTPATH_FDB_SIZE - 1))) {
+			fdb[hole] = fdb[idx];
+			fdb[idx].used = 0;
+			hole = idx;
+		}
+	}
+}
+
+void fastpath_fdb_remove(const uint8_t *mac, int vlan)
+{
+	struct fastpath_entry *e = fdb_slot(mac, vlan);
+
+	if (e && e->used)
+		fdb_remove(e - fdb);
+}
+
+static uint64_t read_be(const uint8_t *p, int n)
+{
+	uint64_t v = 0;
+
+	while (n--)
+		v = v << 8 | *p++;
+	return v;
+}
+
+int fastpath_fdb_hits(uint64_t *keys, int max)
+{
+	int n = 0;
+
+	for (int i = 0; i < FASTPATH_FDB_SIZE && n < max; i++) {
+		if (!fdb[i].used || !fdb[i].hit)
+			continue;
+		fdb[i].hit = 0;
+		keys[n++] = (uint64_t)fdb[i].vlan << 48 | read_be(fdb[i].mac, 6);
+	}
+	return n;
+}
+
+int fastpath_set_lag(int port, const int *members, int count, int l3l4)
+{
+	if (port < 0 || port >= num_ports || count < 0 || count > num_ports)
+		return -EINVAL;
+	for (int i = 0; i < count; i++)
+		if (members[i] < 0 || members[i] >= num_ports)
+			return -EINVAL;
+
+	for (int i = 0; i < count; i++) {
+		lag_members[port * num_ports + i] = members[i];
+		port_lags[members[i]] = port;
+	}
+	lag_counts[port] = count;
+	lag_l3l4[port] = l3l4;
+	return 0;
+}
+
+/* Same hash as lag_hash() in switch.py, so that the frames of a flow take
+ * the same member whether Python or the fast path sends them */
+static uint32_t fastpath_lag_hash(const uint8_t *frame, size_t len, int vlan,
+				  int l3l4)
+{
+	uint64_t x = read_be(frame, 6) ^ read_be(frame + 6, 6) ^ (vlan & 0x0FFF);
+	size_t ip = (frame[12] << 8 | frame[13]) == VLAN_TPID ? 18 : 14;
+	size_t l4;
+
+	if (l3l4 && (frame[ip - 2] << 8 | frame[ip - 1]) == 0x0800 &&
+	    len >= ip + 20) {
+		x ^= read_be(frame + ip + 12, 4) << 16 ^ read_be(frame + ip + 16, 4);
+		/* Fragments after the first have no ports: none are used */
+		l4 = ip + (frame[ip] & 0x0F) * 4;
+		if ((frame[ip + 9] == 6 || frame[ip + 9] == 17) &&
+		    !(read_be(frame + ip + 6, 2) & 0x3FFF) && len >= l4 + 4)
+			x ^= read_be(frame + l4, 4) << 24;
+	}
+
+	/* the low bits of the product only depend on the low bits of x */
+	x ^= x >> 32;
+	return x * 0x9e3779b97f4a7c15ull >> 32;
+}
+
+void fastpath_set_port_state(int port, int state)
+{
+	if (port >= 0 && port < num_ports)
+		port_states[port] = state;
+}
+
+/* Same decision as the Python switch for a known unicast destination */
+static int fastpath_decide(const uint8_t *frame, size_t len, int in, int *out,
+			   int *vlan)
+{
+	int in_vlan, out_vlan, frame_vlan, tagged, port, members;
+	struct fastpath_entry *src;
+
+	/* Multicast and broadcast (BPDUs included) are flooded by Python */
+	if (len < 14 || (frame[0] & 1) || in < 0 || in >= num_ports)
+		return FP_PUNT;
+	/* The MACs are learnt on the logical port of a LAG member */
+	in = port_lags[in];
+
+	tagged = (frame[12] << 8 | frame[13]) == VLAN_TPID;
+	in_vlan = port_vlans[in];
+	if (in_vlan != -1) {
+		if (tagged)
+			return FP_PUNT;
+		frame_vlan = in_vlan;
+	} else {
+		if (!tagged || len < 18)
+			return FP_PUNT;
+		frame_vlan = (frame[14] << 8 | frame[15]) & 0x0FFF;
+	}
+
+	/* ARP goes through Python, which learns the bindings of the senders
+	 * for ARP suppression */
+	if ((frame[tagged ? 16 : 12] << 8 | frame[tagged ? 17 : 13]) == 0x0806)
+		return FP_PUNT;
+
+	/* A new or moved source must be learnt by Python. A known one is
+	 * marked, for Python to keep it from aging out */
+	src = fdb_slot(frame + 6, frame_vlan);
+	if (!src || !src->used || src->port != in)
+		return FP_PUNT;
+	src->hit = 1;
+
+	port = fdb_find(frame, frame_vlan);
+	if (port < 0 || port == in || port >= num_ports)
+		return FP_PUNT;
+
+	members = lag_counts[port];
+	if (members == 0)
+		return FP_DROP;
+	*out = lag_members[port * num_ports + (members == 1 ? 0 :
+		fastpath_lag_hash(frame, len, frame_vlan, lag_l3l4[port]) % members)];
+	*vlan = frame_vlan;
+	out_vlan = port_vlans[port];
+
+	if (in_vlan != -1) {
+		if (out_vlan == -1)
+			return FP_TAG;
+		return out_vlan == in_vlan ? FP_FORWARD : FP_DROP;
+	}
+
+	if (out_vlan == -1)
+		return port_states[port] != -1 ? FP_FORWARD : FP_DROP;
+	return out_vlan == frame_vlan ? FP_UNTAG : FP_DROP;
+}
+
+int fastpath_process(char **frames, int *ifaces, size_t *lengths, int count)
+{
+	int tx_ifaces[MAX_BATCH_LEN];
+	char *heads[MAX_BATCH_LEN], *tails[MAX_BATCH_LEN];
+	size_t head_lens[MAX_BATCH_LEN], tail_lens[MAX_BATCH_LEN];
+	uint8_t tagged_heads[MAX_BATCH_LEN][16];
+	/* Once a frame of a port is punted, the next ones are too, so that
+	 * Python doesn't send them after frames that came later */
+	uint8_t punting[num_ports];
+	int punted = 0, n = 0;
+	int verdict, out, vlan;
+	char *frame;
+	size_t len;
+	int in;
+
+	if (count > MAX_BATCH_LEN)
+		count = MAX_BATCH_LEN;
+	memset(punting, 0, num_ports);
+
+	for (int i = 0; i < count; i++) {
+		frame = frames[i];
+		len = lengths[i];
+		in = ifaces[i];
+
+		verdict = fastpath_decide((uint8_t *)frame, len, in, &out, &vlan);
+		if (verdict == FP_PUNT || punting[in]) {
+			if (in >= 0 && in < num_ports)
+				punting[in] = 1;
+
+			/* Frames before i that were not punted are done with,
+			 * they can be swapped */
+			frames[i] = frames[punted];
+			ifaces[i] = ifaces[punted];
+			lengths[i] = lengths[punted];
+			frames[punted] = frame;
+			ifaces[punted] = in;
+			lengths[punted] = len;
+			punted++;
+			continue;
+		}
+
+		if (verdict == FP_DROP) {
+			stats.dropped++;
+			continue;
+		}
+
+		tx_ifaces[n] = out;
+		switch (verdict) {
+		case FP_FORWARD:
+			heads[n] = frame;
+			head_lens[n] = len;
+			tails[n] = NULL;
+			tail_lens[n] = 0;
+			break;
+		case FP_TAG:
+			memcpy(tagged_heads[n], frame, 12);
+			tagged_heads[n][12] = VLAN_TPID >> 8;
+			tagged_heads[n][13] = VLAN_TPID & 0xff;
+			tagged_heads[n][14] = vlan >> 8 & 0x0F;
+			tagged_heads[n][15] = vlan & 0xff;
+			heads[n] = (char *)tagged_heads[n];
+			head_lens[n] = 16;
+			tails[n] = frame + 12;
+			tail_lens[n] = len - 12;
+			break;
+		case FP_UNTAG:
+			heads[n] = frame;
+			head_lens[n] = 12;
+			tails[n] = frame + 16;
+			tail_lens[n] = len - 16;
+			break;
+		}
+		n++;
+	}
+
+	if (n > 0)
+		stats.forwarded += send_batch(tx_ifaces, heads, head_lens, tails,
+					      tail_lens, n);
+	stats.punted += punted;
+
+	return punted;
+}
+
+void fastpath_get_stats(struct fastpath_stats *out)
+{
+	*out = stats;
+}
@@ -0,0 +1,254 @@
+#include "fdb.h"
+#include <stddef.h>
+#include <errno.h>
+#include <time.h>
+#include <sys/mman.h>
+
+struct fdb_entry {
+	uint32_t seq;	/* 0: never used, odd: being written */
+	int32_t port;	/* -1: forgotten, the entry can be reused */
+	uint64_t key;	/* VLAN << 48 | MAC */
+	uint32_t seen;	/* last time the key was learnt or touched, in seconds;
+			 * not guarded by seq, readers write it too */
+};
+
+static struct fdb_entry *fdb;
+static unsigned int *stp_gen;
+static unsigned int *fdb_gen;
+static int8_t *stp_states;
+static int stp_ports;
+
+int shared_state_create(int num_ports)
+{
+	size_t size = FDB_SIZE * sizeof(*fdb) + sizeof(*stp_gen) +
+		      sizeof(*fdb_gen) + num_ports;
+	void *map;
+
+	/* anonymous and shared: the processes forked afterwards see the same
+	 * pages */
+	map = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_ANONYMOUS,
+		   -1, 0);
+	if (map == MAP_FAILED)
+		return -errno;
+
+	fdb = map;
+	stp_gen = (unsigned int *)(fdb + FDB_SIZE);
+	fdb_gen = stp_gen + 1;
+	stp_states = (int8_t *)(fdb_gen + 1);
+	stp_ports = num_ports;
+	return 0;
+}
+
+static uint32_t fdb_now(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC_COARSE, &ts);
+	return ts.tv_sec;
+}
+
+static unsigned int fdb_hash(uint64_t key)
+{
+	return (key * 0x9e3779b97f4a7c15ull) >> 52 & (FDB_SIZE - 1);
+}
+
+/* return the entry of a key, its port in *port; NULL if it is unknown */
+static struct fdb_entry *fdb_find(uint64_t key, int *port)
+{
+	unsigned int idx = fdb_hash(key);
+	struct fdb_entry *e;
+	uint32_t seq;
+	int match;
+
+	/* entries are never removed (a forgotten one keeps its key, with port
+	 * -1, until it is reused), so the probe can stop at the first one that
+	 * was never used */
+	for (int n = 0; n < FDB_SIZE; n++, idx = (idx + 1) & (FDB_SIZE - 1)) {
+		e = &fdb[idx];
+		do {
+			seq = __atomic_load_n(&e->seq, __ATOMIC_ACQUIRE);
+			if (seq == 0)
+				return NULL;
+			match = __atomic_load_n(&e->key, __ATOMIC_RELAXED) == key;
+			*port = __atomic_load_n(&e->port, __ATOMIC_RELAXED);
+			__atomic_thread_fence(__ATOMIC_ACQUIRE);
+		} while ((seq & 1) || seq != __atomic_load_n(&e->seq, __ATOMIC_RELAXED));
+
+		if (match)
+			return *port >= 0 ? e : NULL;
+	}
+
+	return NULL;
+}
+
+int fdb_lookup(uint64_t key)
+{
+	int port;
+
+	return fdb_find(key, &port) ? port : -1;
+}
+
+int fdb_touch(uint64_t key)
+{
+	struct fdb_entry *e;
+	uint32_t now;
+	int port;
+
+	e = fdb_find(key, &port);
+	if (!e)
+		return -1;
+
+	/* written at most once a second, to keep the cache line shared */
+	now = fdb_now();
+	if (__atomic_load_n(&e->seen, __ATOMIC_RELAXED) != now)
+		__atomic_store_n(&e->seen, now, __ATOMIC_RELAXED);
+	return port;
+}
+
+/* rewrite an entry for the readers */
+static void fdb_write(struct fdb_entry *e, uint64_t key, int port)
+{
+	uint32_t seq = e->seq;
+
+	__atomic_store_n(&e->seq, seq + 1, __ATOMIC_RELAXED);
+	__atomic_thread_fence(__ATOMIC_RELEASE);
+	__atomic_store_n(&e->key, key, __ATOMIC_RELAXED);
+	__atomic_store_n(&e->port, port, __ATOMIC_RELAXED);
+	__atomic_store_n(&e->seq, seq + 2, __ATOMIC_RELEASE);
+}
+
+/* return the entry seen the longest time ago */
+static struct fdb_entry *fdb_oldest(void)
+{
+	struct fdb_entry *oldest = &fdb[0];
+
+	for (int i = 1; i < FDB_SIZE; i++) {
+		if ((int32_t)(__atomic_load_n(&fdb[i].seen, __ATOMIC_RELAXED) -
+			      __atomic_load_n(&oldest->seen, __ATOMIC_RELAXED)) < 0)
+			oldest = &fdb[i];
+	}
+	return oldest;
+}
+
+int fdb_learn(uint64_t key, int port)
+{
+	unsigned int idx = fdb_hash(key);
+	struct fdb_entry *e, *free = NULL;
+	uint32_t now = fdb_now();
+	int evicted = 0;
+
+	for (int n = 0; n < FDB_SIZE; n++, idx = (idx + 1) & (FDB_SIZE - 1)) {
+		e = &fdb[idx];
+		if (e->seq == 0)
+			break;
+		if (e->key != key) {
+			/* a forgotten entry on the probe path can take any key */
+			if (!free && e->port < 0)
+				free = e;
+			continue;
+		}
+
+		__atomic_store_n(&e->seen, now, __ATOMIC_RELAXED);
+		if (e->port == port)
+			return 0;
+		/* a move invalidates what the readers derived from the old
+		 * port */
+		if (e->port >= 0) {
+			fdb_write(e, key, port);
+			__atomic_add_fetch(fdb_gen, 1, __ATOMIC_RELEASE);
+			return 0;
+		}
+		/* forgotten: written again below, in the first free entry */
+		if (!free)
+			free = e;
+		break;
+	}
+
+	if (!free && e->seq == 0)
+		free = e;
+	if (!free) {
+		/* every entry holds a key: the least recently seen one makes
+		 * room. As no entry was never used, any entry is on the probe
+		 * path of the key. */
+		free = fdb_oldest();
+		evicted = 1;
+	}
+
+	__atomic_store_n(&free->seen, now, __ATOMIC_RELAXED);
+	fdb_write(free, key, port);
+	if (evicted)
+		__atomic_add_fetch(fdb_gen, 1, __ATOMIC_RELEASE);
+	return evicted;
+}
+
+int fdb_flush(int vlan, int port)
+{
+	struct fdb_entry *e;
+	int flushed = 0;
+
+	for (int i = 0; i < FDB_SIZE; i++) {
+		e = &fdb[i];
+		if (e->seq == 0 || e->port < 0)
+			continue;
+		if (vlan >= 0 && (int)(e->key >> 48) != vlan)
+			continue;
+		if (port >= 0 && e->port != port)
+			continue;
+
+		fdb_write(e, e->key, -1);
+		flushed++;
+	}
+
+	if (flushed)
+		__atomic_add_fetch(fdb_gen, 1, __ATOMIC_RELEASE);
+	return flushed;
+}
+
+int fdb_expire(unsigned int aging_time)
+{
+	uint32_t now = fdb_now();
+	struct fdb_entry *e;
+	int expired = 0;
+
+	for (int i = 0; i < FDB_SIZE; i++) {
+		e = &fdb[i];
+		if (e->seq == 0 || e->port < 0)
+			continue;
+		if (now - __atomic_load_n(&e->seen, __ATOMIC_RELAXED) < aging_time)
+			continue;
+
+		fdb_write(e, e->key, -1);
+		expired++;
+	}
+
+	if (expired)
+		__atomic_add_fetch(fdb_gen, 1, __ATOMIC_RELEASE);
+	return expired;
+}
+
+int stp_get_state(int port)
+{
+	if (port < 0 || port >= stp_ports)
+		return 0;
+	return __atomic_load_n(&stp_states[port], __ATOMIC_RELAXED);
+}
+
+void stp_set_state(int port, int state)
+{
+	if (port < 0 || port >= stp_ports)
+		return;
+	if (__atomic_load_n(&stp_states[port], __ATOMIC_RELAXED) == state)
+		return;
+	__atomic_store_n(&stp_states[port], state, __ATOMIC_RELAXED);
+	__atomic_add_fetch(stp_gen, 1, __ATOMIC_RELEASE);
+}
+
+unsigned int stp_generation(void)
+{
+	return __atomic_load_n(stp_gen, __ATOMIC_ACQUIRE);
+}
+
+unsigned int fdb_generation(void)
+{
+	return __atomic_load_n(fdb_gen, __ATOMIC_ACQUIRE);
+}
@@ -1,4 +1,6 @@
+#define _GNU_SOURCE
 #include "lib.h"
+#include "fastpath.h"
 
 #include <sys/ioctl.h>
 #include <net/if.h>
@@ -16,9 +18,216 @@
 #include <sys/socket.h>
 #include <netinet/in.h>
 #include <arpa/inet.h>
+#include <sys/epoll.h>
+#include <sys/mman.h>
+#include <pthread.h>
+#include <errno.h>
+#include <linux/filter.h>
+#include <poll.h>
 
+#ifndef PACKET_IGNORE_OUTGOING
+#define PACKET_IGNORE_OUTGOING 23
+#endif
+#ifndef PACKET_FANOUT_FLAG_IGNORE_OUTGOING
+#define PACKET_FANOUT_FLAG_IGNORE_OUTGOING 0x4000
+#endif
 
-int interfaces[SWITCH_NUM_INTERFACES];
+
+/* Sized from the interfaces given to init */
+int *interfaces;
+int num_interfaces;
+/* Names of the interfaces given to init */
+static char (*interface_names)[IFNAMSIZ];
+
+/* MTU of every interface, the longest frame it can send (MTU +
+ * ETH_HEADER_LEN) and its size drops */
+static int *mtus;
+static size_t *tx_limits;
+static struct link_stats *link_stats;
+/* Size of the receive buffers */
+static size_t max_frame_len = MAX_PACKET_LEN;
+
+/* TPACKET_V3 receive ring of an interface */
+struct rx_ring {
+	uint8_t *map;
+	size_t size;
+	unsigned int block_size;
+	unsigned int block_nr;
+	unsigned int cur_block;	/* block being walked */
+	unsigned int held_nr;	/* walked blocks before cur_block not yet given back */
+	int walking;		/* cur_block has been started */
+	unsigned int pkt_left;	/* packets of cur_block not walked yet */
+	struct tpacket3_hdr *next_pkt;
+};
+
+/* PACKET_TX_RING of an interface */
+struct tx_ring {
+	uint8_t *map;
+	size_t size;
+	unsigned int frame_size;
+	unsigned int frame_nr;
+	unsigned int head;	/* next slot to fill */
+	unsigned int pending;	/* frames queued since the last kick */
+	pthread_mutex_t lock;
+};
+
+/* Frame data starts right after the tpacket3_hdr in a TX slot */
+#define TX_RING_DATA_OFFSET (TPACKET3_HDRLEN - sizeof(struct sockaddr_ll))
+
+static int rx_backend = RX_BACKEND_SOCKET;
+static int tx_backend = TX_BACKEND_SOCKET;
+static struct rx_ring *rx_rings;
+static struct tx_ring *tx_rings;
+/* Rings with walked blocks to give back, so that ring_release doesn't have to
+ * look at every interface */
+static int *held_rings;
+static int held_rings_nr;
+
+/* Every socket is registered once in epfd. The ready interfaces returned by
+ * the last epoll_wait are served one after the other (round-robin) before
+ * waiting again, so a busy interface can't starve the others. */
+static int epfd = -1;
+static struct epoll_event *ready_events;
+static int ready_nr;
+static int ready_next;
+
+/* Bounded queue of the frames waiting to leave on an interface, drained by
+ * the transmit thread of the interface */
+struct egress_queue {
+	pthread_mutex_t lock;
+	pthread_cond_t cond;
+	char **frames;		/* waiting frames, the oldest at head */
+	size_t *lens;
+	unsigned int head;
+	unsigned int len;
+	char **free_bufs;	/* buffers neither queued nor being sent */
+	unsigned int free_nr;
+	struct egress_stats stats;
+	pthread_t thread;
+};
+
+/* NULL until egress_queues_start: frames are sent by the caller */
+static struct egress_queue *egress_queues;
+static unsigned int egress_capacity;
+static int egress_policy;
+
+static int egress_send(int intidx, char *head, size_t head_len, char *tail,
+		       size_t tail_len);
+static int egress_send_batch(int *ifaces, char **heads, size_t *head_lens,
+			     char **tails, size_t *tail_lens, int count);
+
+/* Frames the interface can't send are dropped and counted here, instead of
+ * being refused by the kernel */
+static int frame_fits(int intidx, size_t len)
+{
+	if (len <= tx_limits[intidx])
+		return 1;
+	__atomic_add_fetch(&link_stats[intidx].tx_oversize, 1, __ATOMIC_RELAXED);
+	return 0;
+}
+
+/* A receive error of an interface (e.g. ENETDOWN once its link went down) is
+ * counted, never fatal: the interface is left out of this round, and the
+ * others are served */
+static void count_rx_error(int intidx, int err)
+{
+	if (err != EAGAIN && err != EINTR)
+		__atomic_add_fetch(&link_stats[intidx].rx_errors, 1, __ATOMIC_RELAXED);
+}
+
+/* Drops the received frames that didn't fit in their buffer (their length is
+ * then above frame_size), keeping the others in order. The buffers of the
+ * dropped frames stay in frames, after the returned count */
+static int drop_oversize(char **frames, int *ifaces, size_t *lengths,
+			 int count, size_t frame_size)
+{
+	char *frame;
+	int n = 0;
+
+	for (int i = 0; i < count; i++) {
+		if (lengths[i] > frame_size) {
+			__atomic_add_fetch(&link_stats[ifaces[i]].rx_oversize, 1,
+					   __ATOMIC_RELAXED);
+			continue;
+		}
+		frame = frames[n];
+		frames[n] = frames[i];
+		frames[i] = frame;
+		ifaces[n] = ifaces[i];
+		lengths[n] = lengths[i];
+		n++;
+	}
+
+	return n;
+}
+
+/* Asks the kernel to send every frame queued in the TX ring of an interface.
+ * Must be called with the ring locked. */
+static int tx_ring_kick(int intidx)
+{
+	int ret;
+
+	tx_rings[intidx].pending = 0;
+	ret = send(interfaces[intidx], NULL, 0, MSG_DONTWAIT);
+	if (ret == -1 && errno != EAGAIN && errno != ENOBUFS)
+		return -errno;
+	return 0;
+}
+
+/* Copies a frame (head followed by tail) in the next slot of the TX ring of an
+ * interface. Must be called with the ring locked.
+ * Returns: the length of the frame, -ENOBUFS if the ring is full or -EMSGSIZE
+ * if the frame doesn't fit in a slot. */
+static int tx_ring_enqueue(int intidx, char *head, size_t head_len, char *tail,
+			   size_t tail_len)
+{
+	struct tx_ring *ring = &tx_rings[intidx];
+	struct tpacket3_hdr *hdr;
+	uint8_t *data;
+
+	if (head_len + tail_len > ring->frame_size - TX_RING_DATA_OFFSET)
+		return -EMSGSIZE;
+
+	hdr = (struct tpacket3_hdr *)(ring->map + (size_t)ring->head * ring->frame_size);
+	if (__atomic_load_n(&hdr->tp_status, __ATOMIC_ACQUIRE) != TP_STATUS_AVAILABLE) {
+		/* Let the kernel catch up with what is already queued */
+		if (ring->pending)
+			tx_ring_kick(intidx);
+		if (__atomic_load_n(&hdr->tp_status, __ATOMIC_ACQUIRE) != TP_STATUS_AVAILABLE)
+			return -ENOBUFS;
+	}
+
+	data = (uint8_t *)hdr + TX_RING_DATA_OFFSET;
+	memcpy(data, head, head_len);
+	if (tail_len)
+		memcpy(data + head_len, tail, tail_len);
+	hdr->tp_len = head_len + tail_len;
+	hdr->tp_next_offset = 0;
+	__atomic_store_n(&hdr->tp_status, TP_STATUS_SEND_REQUEST, __ATOMIC_RELEASE);
+
+	ring->head = (ring->head + 1) % ring->frame_nr;
+	ring->pending++;
+	return head_len + tail_len;
+}
+
+/* Queues a frame in the TX ring and sends it right away */
+static int tx_ring_send(int intidx, char *head, size_t head_len, char *tail,
+			size_t tail_len)
+{
+	struct tx_ring *ring = &tx_rings[intidx];
+	int ret, res;
+
+	pthread_mutex_lock(&ring->lock);
+	ret = tx_ring_enqueue(intidx, head, head_len, tail, tail_len);
+	if (ring->pending) {
+		res = tx_ring_kick(intidx);
+		if (ret >= 0 && res < 0)
+			ret = res;
+	}
+	pthread_mutex_unlock(&ring->lock);
+
+	return ret;
+}
 
 int get_sock(const char *if_name)
 {
@@ -48,15 +257,59 @@ int send_to_link(int intidx, char *frame_data, size_t len)
 	 * interface, eg 1500 bytes 
 	 */
 	int ret;
+
+	if (!frame_fits(intidx, len))
+		return -EMSGSIZE;
+	if (egress_queues)
+		return egress_send(intidx, frame_data, len, NULL, 0);
+	if (tx_backend == TX_BACKEND_RING)
+		return tx_ring_send(intidx, frame_data, len, NULL, 0);
+
 	ret = write(interfaces[intidx], frame_data, len);
-	DIE(ret == -1, "write");
+	if (ret == -1)
+		return -errno;
 	return ret;
 }
 
+int send_to_link_iov(int intidx, char *head, size_t head_len, char *tail,
+		     size_t tail_len)
+{
+	struct iovec iov[2] = {
+		{ .iov_base = head, .iov_len = head_len },
+		{ .iov_base = tail, .iov_len = tail_len },
+	};
+	struct msghdr msg;
+	int ret;
+
+	if (!frame_fits(intidx, head_len + tail_len))
+		return -EMSGSIZE;
+	if (egress_queues)
+		return egress_send(intidx, head, head_len, tail, tail_len);
+	if (tx_backend == TX_BACKEND_RING)
+		return tx_ring_send(intidx, head, head_len, tail, tail_len);
+
+	memset(&msg, 0, sizeof(msg));
+	msg.msg_iov = iov;
+	msg.msg_iovlen = 2;
+
+	ret = sendmsg(interfaces[intidx], &msg, 0);
+	if (ret == -1)
+		return -errno;
+	return ret;
+}
+
+/* A frame larger than the buffer is dropped: -EMSGSIZE */
 ssize_t receive_from_link(int intidx, char *frame_data)
 {
 	ssize_t ret;
-  ret = read(interfaces[intidx], frame_data, MAX_PACKET_LEN);
+	ret = recv(interfaces[intidx], frame_data, max_frame_len,
+		   MSG_DONTWAIT | MSG_TRUNC);
+	if (ret < 0)
+		count_rx_error(intidx, errno);
+	if (ret > (ssize_t)max_frame_len) {
+		__atomic_add_fetch(&link_stats[intidx].rx_oversize, 1, __ATOMIC_RELAXED);
+		return -EMSGSIZE;
+	}
 	return ret;
 }
 
@@ -66,37 +319,521 @@ int socket_receive_message(int sockfd, char *frame_data, size_t *len)
 	 * Note that "buffer" should be at least the MTU size of the
 	 * interface, eg 1500 bytes
 	 * */
-	int ret = read(sockfd, frame_data, MAX_PACKET_LEN);
+	int ret = read(sockfd, frame_data, max_frame_len);
 	DIE(ret < 0, "read");
 	*len = ret;
 	return 0;
 }
 
+/* Waits for ready interfaces if every interface of the last wait was served.
+ * The pending error of a socket (EPOLLERR, e.g. its link went down) is read
+ * and counted here, so that a down interface drops out of the ready set
+ * instead of being reported again by every epoll_wait */
+static void wait_ready_interfaces(void)
+{
+	socklen_t len;
+	int err;
+
+	while (ready_next >= ready_nr) {
+		ready_nr = epoll_wait(epfd, ready_events, num_interfaces, -1);
+		if (ready_nr < 0) {
+			DIE(errno != EINTR, "epoll_wait");
+			ready_nr = 0;
+		}
+		ready_next = 0;
+
+		for (int i = 0; i < ready_nr; i++) {
+			if (!(ready_events[i].events & EPOLLERR))
+				continue;
+			err = 0;
+			len = sizeof(err);
+			getsockopt(interfaces[ready_events[i].data.u32], SOL_SOCKET,
+				   SO_ERROR, &err, &len);
+			if (err)
+				count_rx_error(ready_events[i].data.u32, err);
+		}
+	}
+}
+
+/* Returns the next interface to serve, waiting if needed */
+static int next_ready_interface(void)
+{
+	wait_ready_interfaces();
+	return ready_events[ready_next++].data.u32;
+}
+
 int recv_from_any_link(char *frame_data, size_t *length) {
-	int res;
-	fd_set set;
+	ssize_t ret;
+	int intidx;
 
-	FD_ZERO(&set);
 	while (1) {
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++) {
-			FD_SET(interfaces[i], &set);
+		intidx = next_ready_interface();
+
+		/* The interface may have been drained since it was reported */
+		ret = receive_from_link(intidx, frame_data);
+		if (ret < 0)
+			continue;
+		*length = ret;
+		return intidx;
+	}
+
+	return -1;
+}
+
+static void setup_recv_msgs(struct mmsghdr *msgs, struct iovec *iovs,
+			    char **frames, size_t frame_size, int n)
+{
+	for (int i = 0; i < n; i++) {
+		iovs[i].iov_base = frames[i];
+		iovs[i].iov_len = frame_size;
+		memset(&msgs[i], 0, sizeof(msgs[i]));
+		msgs[i].msg_hdr.msg_iov = &iovs[i];
+		msgs[i].msg_hdr.msg_iovlen = 1;
+	}
+}
+
+int recv_batch(char **frames, size_t frame_size, int *ifaces, size_t *lengths,
+	       int max_frames)
+{
+	struct mmsghdr msgs[MAX_BATCH_LEN];
+	struct iovec iovs[MAX_BATCH_LEN];
+	int count = 0;
+	int res, intidx, quota;
+
+	if (max_frames > MAX_BATCH_LEN)
+		max_frames = MAX_BATCH_LEN;
+
+	/* Until some frames are left for the caller, once the fast path has
+	 * taken the ones it forwards */
+	while (count == 0) {
+		setup_recv_msgs(msgs, iovs, frames, frame_size, max_frames);
+
+		/* Serve the ready interfaces in turn, each one getting an equal
+		 * share of the batch, until the batch is full or they are all
+		 * served */
+		while (count == 0 || (ready_next < ready_nr && count < max_frames)) {
+			if (count == 0)
+				wait_ready_interfaces();
+
+			quota = (max_frames - count + ready_nr - ready_next - 1) /
+				(ready_nr - ready_next);
+			intidx = next_ready_interface();
+
+			/* MSG_TRUNC: the length of a frame larger than its
+			 * buffer is its full length */
+			res = recvmmsg(interfaces[intidx], msgs + count, quota,
+				       MSG_DONTWAIT | MSG_TRUNC, NULL);
+			if (res < 0) {
+				count_rx_error(intidx, errno);
+				continue;
+			}
+
+			for (int j = count; j < count + res; j++) {
+				ifaces[j] = intidx;
+				lengths[j] = msgs[j].msg_len;
+			}
+			count += res;
 		}
 
-		res = select(interfaces[SWITCH_NUM_INTERFACES - 1] + 1, &set, NULL, NULL, NULL);
-		DIE(res == -1, "select");
+		count = drop_oversize(frames, ifaces, lengths, count, frame_size);
+		if (count > 0 && fastpath_enabled())
+			count = fastpath_process(frames, ifaces, lengths, count);
+	}
 
-		for (int i = 0; i < SWITCH_NUM_INTERFACES; i++) {
-			if (FD_ISSET(interfaces[i], &set)) {
-				ssize_t ret = receive_from_link(i, frame_data);
-        if (ret < 0)
-          continue;
-				*length = ret;
-				return i;
+	return count;
+}
+
+int recv_batch_from_link(int intidx, char **frames, size_t frame_size,
+			 size_t *lengths, int max_frames)
+{
+	struct mmsghdr msgs[MAX_BATCH_LEN];
+	struct iovec iovs[MAX_BATCH_LEN];
+	int ifaces[MAX_BATCH_LEN];
+	int res;
+
+	if (max_frames > MAX_BATCH_LEN)
+		max_frames = MAX_BATCH_LEN;
+
+	setup_recv_msgs(msgs, iovs, frames, frame_size, max_frames);
+
+	res = recvmmsg(interfaces[intidx], msgs, max_frames,
+		       MSG_DONTWAIT | MSG_TRUNC, NULL);
+	if (res < 0) {
+		count_rx_error(intidx, errno);
+		return 0;
+	}
+
+	for (int i = 0; i < res; i++) {
+		ifaces[i] = intidx;
+		lengths[i] = msgs[i].msg_len;
+	}
+
+	res = drop_oversize(frames, ifaces, lengths, res, frame_size);
+	if (res > 0 && fastpath_enabled())
+		res = fastpath_process(frames, ifaces, lengths, res);
+
+	return res;
+}
+
+int get_interface_fd(int intidx)
+{
+	return interfaces[intidx];
+}
+
+/* Sends n messages on a socket. A frame the kernel refuses (e.g. ENOBUFS, or
+ * ENETDOWN) is dropped; with MSG_DONTWAIT in flags, a full socket is waited on
+ * with poll. Returns: the number of frames sent. */
+static int send_msgs(int sockfd, struct mmsghdr *msgs, int n, int flags)
+{
+	struct pollfd pfd = { .fd = sockfd, .events = POLLOUT };
+	int done = 0, sent = 0;
+	int ret;
+
+	while (done < n) {
+		ret = sendmmsg(sockfd, msgs + done, n - done, flags);
+		if (ret < 0) {
+			if (errno == EAGAIN)
+				poll(&pfd, 1, 100);
+			else if (errno != EINTR)
+				done++;
+			continue;
+		}
+		done += ret;
+		sent += ret;
+	}
+
+	return sent;
+}
+
+/* send_batch for TX_BACKEND_RING: queue everything, then one kick per ring */
+static int tx_ring_send_batch(int *ifaces, char **heads, size_t *head_lens,
+			      char **tails, size_t *tail_lens, int count)
+{
+	struct tx_ring *ring;
+	uint8_t done[count];
+	int sent = 0;
+	int i;
+
+	memset(done, 0, count);
+
+	/* Only the interfaces that have frames to send are looked at */
+	for (int first = 0; first < count; first++) {
+		if (done[first])
+			continue;
+		i = ifaces[first];
+		ring = &tx_rings[i];
+
+		pthread_mutex_lock(&ring->lock);
+		for (int j = first; j < count; j++) {
+			if (done[j] || ifaces[j] != i)
+				continue;
+			done[j] = 1;
+
+			/* Frames that don't fit are dropped; the caller sees it
+			 * in the returned count */
+			if (!frame_fits(i, head_lens[j] + (tails ? tail_lens[j] : 0)))
+				continue;
+			if (tx_ring_enqueue(i, heads[j], head_lens[j],
+					    tails ? tails[j] : NULL,
+					    tails ? tail_lens[j] : 0) >= 0)
+				sent++;
+		}
+		if (ring->pending)
+			tx_ring_kick(i);
+		pthread_mutex_unlock(&ring->lock);
+	}
+
+	return sent;
+}
+
+int send_batch(int *ifaces, char **heads, size_t *head_lens, char **tails,
+	       size_t *tail_lens, int count)
+{
+	struct mmsghdr msgs[MAX_BATCH_LEN];
+	struct iovec iovs[2 * MAX_BATCH_LEN];
+	uint8_t done[count];
+	int sent = 0;
+	int i, n;
+
+	if (count == 0)
+		return 0;
+
+	if (egress_queues)
+		return egress_send_batch(ifaces, heads, head_lens, tails,
+					 tail_lens, count);
+	if (tx_backend == TX_BACKEND_RING)
+		return tx_ring_send_batch(ifaces, heads, head_lens, tails,
+					  tail_lens, count);
+
+	memset(done, 0, count);
+
+	/* One sendmmsg per interface (and per MAX_BATCH_LEN frames), keeping the
+	 * order of the frames that leave on the same interface. Only the
+	 * interfaces that have frames to send are looked at. */
+	for (int first = 0; first < count; first++) {
+		if (done[first])
+			continue;
+		i = ifaces[first];
+
+		n = 0;
+		for (int j = first; j < count; j++) {
+			if (done[j] || ifaces[j] != i)
+				continue;
+			done[j] = 1;
+			if (!frame_fits(i, head_lens[j] + (tails ? tail_lens[j] : 0)))
+				continue;
+
+			memset(&msgs[n], 0, sizeof(msgs[n]));
+			iovs[2 * n].iov_base = heads[j];
+			iovs[2 * n].iov_len = head_lens[j];
+			iovs[2 * n + 1].iov_base = tails ? tails[j] : NULL;
+			iovs[2 * n + 1].iov_len = tails ? tail_lens[j] : 0;
+			msgs[n].msg_hdr.msg_iov = &iovs[2 * n];
+			msgs[n].msg_hdr.msg_iovlen = iovs[2 * n + 1].iov_len ? 2 : 1;
+			n++;
+
+			if (n == MAX_BATCH_LEN) {
+				sent += send_msgs(interfaces[i], msgs, n, 0);
+				n = 0;
 			}
 		}
+
+		if (n > 0)
+			sent += send_msgs(interfaces[i], msgs, n, 0);
 	}
 
-	return -1;
+	return sent;
+}
+
+/* Copies a frame at the end of an egress queue. Must be called with the queue
+ * locked. Returns: the length of the frame, or -ENOBUFS if it was dropped
+ * (EGRESS_DROP_TAIL and the queue is full). */
+static int egress_push(struct egress_queue *q, char *head, size_t head_len,
+		       char *tail, size_t tail_len)
+{
+	unsigned int idx;
+	char *buf;
+
+	if (q->len == egress_capacity) {
+		q->stats.dropped++;
+		if (egress_policy == EGRESS_DROP_TAIL)
+			return -ENOBUFS;
+
+		/* EGRESS_DROP_HEAD: the oldest frame makes room */
+		buf = q->frames[q->head];
+		q->head = (q->head + 1) % egress_capacity;
+		q->len--;
+	} else {
+		/* There are MAX_BATCH_LEN more buffers than queue slots, for
+		 * the frames being sent, so one is always free here */
+		buf = q->free_bufs[--q->free_nr];
+	}
+
+	memcpy(buf, head, head_len);
+	if (tail_len)
+		memcpy(buf + head_len, tail, tail_len);
+
+	idx = (q->head + q->len) % egress_capacity;
+	q->frames[idx] = buf;
+	q->lens[idx] = head_len + tail_len;
+	q->len++;
+
+	q->stats.enqueued++;
+	q->stats.depth = q->len;
+	if (q->len > q->stats.max_depth)
+		q->stats.max_depth = q->len;
+	return head_len + tail_len;
+}
+
+static int egress_send(int intidx, char *head, size_t head_len, char *tail,
+		       size_t tail_len)
+{
+	struct egress_queue *q = &egress_queues[intidx];
+	int ret;
+
+	pthread_mutex_lock(&q->lock);
+	ret = egress_push(q, head, head_len, tail, tail_len);
+	pthread_cond_signal(&q->cond);
+	pthread_mutex_unlock(&q->lock);
+
+	return ret;
+}
+
+/* send_batch with egress queues: each queue is locked and its transmit thread
+ * woken up once per batch */
+static int egress_send_batch(int *ifaces, char **heads, size_t *head_lens,
+			     char **tails, size_t *tail_lens, int count)
+{
+	struct egress_queue *q;
+	uint8_t done[count];
+	size_t tail_len;
+	int queued = 0;
+	int i;
+
+	memset(done, 0, count);
+
+	for (int first = 0; first < count; first++) {
+		if (done[first])
+			continue;
+		i = ifaces[first];
+		q = &egress_queues[i];
+
+		pthread_mutex_lock(&q->lock);
+		for (int j = first; j < count; j++) {
+			if (done[j] || ifaces[j] != i)
+				continue;
+			done[j] = 1;
+
+			tail_len = tails ? tail_lens[j] : 0;
+			if (!frame_fits(i, head_lens[j] + tail_len))
+				continue;
+			if (egress_push(q, heads[j], head_lens[j],
+					tails ? tails[j] : NULL, tail_len) >= 0)
+				queued++;
+		}
+		pthread_cond_signal(&q->cond);
+		pthread_mutex_unlock(&q->lock);
+	}
+
+	return queued;
+}
+
+/* Sends frames taken from an egress queue, waiting for room in the socket or
+ * the TX ring. Returns: the number of frames sent. */
+static int egress_transmit(int intidx, char **bufs, size_t *lens, int n)
+{
+	struct pollfd pfd = { .fd = interfaces[intidx], .events = POLLOUT };
+	struct mmsghdr msgs[MAX_BATCH_LEN];
+	struct iovec iovs[MAX_BATCH_LEN];
+	struct tx_ring *ring;
+	int sent = 0;
+	int ret;
+
+	if (tx_backend == TX_BACKEND_RING) {
+		ring = &tx_rings[intidx];
+		pthread_mutex_lock(&ring->lock);
+		for (int i = 0; i < n; i++) {
+			ret = tx_ring_enqueue(intidx, bufs[i], lens[i], NULL, 0);
+			while (ret == -ENOBUFS) {
+				pthread_mutex_unlock(&ring->lock);
+				poll(&pfd, 1, 100);
+				pthread_mutex_lock(&ring->lock);
+				ret = tx_ring_enqueue(intidx, bufs[i], lens[i], NULL, 0);
+			}
+			if (ret >= 0)
+				sent++;
+		}
+		if (ring->pending)
+			tx_ring_kick(intidx);
+		pthread_mutex_unlock(&ring->lock);
+		return sent;
+	}
+
+	for (int i = 0; i < n; i++) {
+		memset(&msgs[i], 0, sizeof(msgs[i]));
+		iovs[i].iov_base = bufs[i];
+		iovs[i].iov_len = lens[i];
+		msgs[i].msg_hdr.msg_iov = &iovs[i];
+		msgs[i].msg_hdr.msg_iovlen = 1;
+	}
+
+	return send_msgs(interfaces[intidx], msgs, n, MSG_DONTWAIT);
+}
+
+/* Transmit thread of an interface. The queue is only locked to take the
+ * frames out and give the buffers back, never while writing. */
+static void *egress_thread(void *arg)
+{
+	int intidx = (intptr_t)arg;
+	struct egress_queue *q = &egress_queues[intidx];
+	char *bufs[MAX_BATCH_LEN];
+	size_t lens[MAX_BATCH_LEN];
+	int n, sent;
+
+	while (1) {
+		pthread_mutex_lock(&q->lock);
+		while (q->len == 0)
+			pthread_cond_wait(&q->cond, &q->lock);
+
+		for (n = 0; n < MAX_BATCH_LEN && q->len > 0; n++) {
+			bufs[n] = q->frames[q->head];
+			lens[n] = q->lens[q->head];
+			q->head = (q->head + 1) % egress_capacity;
+			q->len--;
+		}
+		q->stats.depth = q->len;
+		pthread_mutex_unlock(&q->lock);
+
+		sent = egress_transmit(intidx, bufs, lens, n);
+
+		pthread_mutex_lock(&q->lock);
+		for (int i = 0; i < n; i++)
+			q->free_bufs[q->free_nr++] = bufs[i];
+		q->stats.sent += sent;
+		q->stats.errors += n - sent;
+		pthread_mutex_unlock(&q->lock);
+	}
+
+	return NULL;
+}
+
+int egress_queues_start(unsigned int capacity, int policy)
+{
+	struct egress_queue *queues;
+	unsigned int buf_nr = capacity + MAX_BATCH_LEN;
+	struct egress_queue *q;
+	char *bufs;
+	int res;
+
+	if (capacity == 0 || egress_queues)
+		return -EINVAL;
+
+	queues = calloc(num_interfaces, sizeof(*queues));
+	if (!queues)
+		return -ENOMEM;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		q = &queues[i];
+		q->frames = calloc(capacity, sizeof(*q->frames));
+		q->lens = calloc(capacity, sizeof(*q->lens));
+		q->free_bufs = calloc(buf_nr, sizeof(*q->free_bufs));
+		/* Only frames that fit the MTU are queued */
+		bufs = malloc((size_t)buf_nr * tx_limits[i]);
+		if (!q->frames || !q->lens || !q->free_bufs || !bufs)
+			return -ENOMEM;
+
+		for (unsigned int j = 0; j < buf_nr; j++)
+			q->free_bufs[j] = bufs + (size_t)j * tx_limits[i];
+		q->free_nr = buf_nr;
+		pthread_mutex_init(&q->lock, NULL);
+		pthread_cond_init(&q->cond, NULL);
+	}
+
+	egress_capacity = capacity;
+	egress_policy = policy;
+	egress_queues = queues;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		res = pthread_create(&queues[i].thread, NULL, egress_thread,
+				     (void *)(intptr_t)i);
+		DIE(res != 0, "pthread_create");
+	}
+
+	return 0;
+}
+
+int get_egress_stats(int intidx, struct egress_stats *stats)
+{
+	struct egress_queue *q;
+
+	if (!egress_queues)
+		return -1;
+
+	q = &egress_queues[intidx];
+	pthread_mutex_lock(&q->lock);
+	*stats = q->stats;
+	pthread_mutex_unlock(&q->lock);
+	return 0;
 }
 
 char *get_interface_ip(int interface)
@@ -114,21 +851,22 @@ char *get_interface_ip(int interface)
 }
 
 char *get_interface_name(int interface)
+{
+	return interface_names[interface];
+}
+
+int get_link_up(int intidx)
 {
 	struct ifreq ifr;
-	int ret;
-	if (interface == 0)
-		sprintf(ifr.ifr_name, "rr-0-1");
-	else {
-		sprintf(ifr.ifr_name, "r-%u", interface - 1);
-	}
 
-  ifr.ifr_ifindex = interface + 2;
-	ret = ioctl(interfaces[interface], SIOCGIFNAME, &ifr);
-	DIE(ret == -1, "ioctl SIOCGIFNAME");
-  char *int_name = malloc(256);
-  strncpy(int_name, ifr.ifr_name, 256);
-  return int_name;
+	if (intidx < 0 || intidx >= num_interfaces)
+		return -EINVAL;
+
+	memset(&ifr, 0, sizeof(ifr));
+	memcpy(ifr.ifr_name, interface_names[intidx], IFNAMSIZ);
+	if (ioctl(interfaces[intidx], SIOCGIFFLAGS, &ifr) == -1)
+		return -errno;
+	return (ifr.ifr_flags & IFF_UP) && (ifr.ifr_flags & IFF_RUNNING);
 }
 
 void get_interface_mac(int interface, uint8_t *mac)
@@ -188,12 +926,449 @@ int hwaddr_aton(const char *txt, uint8_t *addr)
 	return 0;
 }
 
-int init(int argc, char *argv[])
+/* The smallest power of 2 that is at least size and min */
+static unsigned int ring_size(size_t size, unsigned int min)
 {
-  for (int i = 0; i < argc; ++i) {
-		printf("Setting up interface: %s\n", argv[i]);
+	unsigned int n = min;
+
+	while (n < size)
+		n <<= 1;
+	return n;
+}
+
+/* Sets up the TPACKET_V3 rings requested by the backends on the socket of an
+ * interface. Both rings share one mapping, the RX ring first. The blocks and
+ * the TX slots are grown to hold the largest frame of the interface. */
+static void setup_rings(int intidx)
+{
+	struct rx_ring *rx = &rx_rings[intidx];
+	struct tx_ring *tx = &tx_rings[intidx];
+	struct tpacket_req3 req;
+	int version = TPACKET_V3;
+	int loss = 1;
+	size_t rx_size = 0, tx_size = 0;
+	uint8_t *map;
+	int res;
+
+	res = setsockopt(interfaces[intidx], SOL_PACKET, PACKET_VERSION, &version,
+			 sizeof(version));
+	DIE(res == -1, "setsockopt PACKET_VERSION");
+
+	/* Skip malformed frames instead of stalling the TX ring. This has to be
+	 * set before any ring. */
+	if (tx_backend == TX_BACKEND_RING) {
+		res = setsockopt(interfaces[intidx], SOL_PACKET, PACKET_LOSS, &loss,
+				 sizeof(loss));
+		DIE(res == -1, "setsockopt PACKET_LOSS");
+	}
+
+	memset(rx, 0, sizeof(*rx));
+	if (rx_backend == RX_BACKEND_RING) {
+		memset(&req, 0, sizeof(req));
+		req.tp_block_size = ring_size(2 * (TPACKET3_HDRLEN + max_frame_len),
+					      RX_RING_BLOCK_SIZE);
+		req.tp_block_nr = RX_RING_BLOCK_NR;
+		req.tp_frame_size = RX_RING_FRAME_SIZE;
+		req.tp_frame_nr = (req.tp_block_size / RX_RING_FRAME_SIZE) * RX_RING_BLOCK_NR;
+		req.tp_retire_blk_tov = RX_RING_BLOCK_TIMEOUT;
+		res = setsockopt(interfaces[intidx], SOL_PACKET, PACKET_RX_RING, &req,
+				 sizeof(req));
+		DIE(res == -1, "setsockopt PACKET_RX_RING");
+
+		rx->block_size = req.tp_block_size;
+		rx->block_nr = req.tp_block_nr;
+		rx->size = rx_size = (size_t)req.tp_block_size * req.tp_block_nr;
+	}
+
+	memset(tx, 0, sizeof(*tx));
+	if (tx_backend == TX_BACKEND_RING) {
+		memset(&req, 0, sizeof(req));
+		req.tp_frame_size = ring_size(TX_RING_DATA_OFFSET + tx_limits[intidx],
+					      TX_RING_FRAME_SIZE);
+		req.tp_block_size = ring_size(req.tp_frame_size, TX_RING_BLOCK_SIZE);
+		req.tp_block_nr = TX_RING_BLOCK_NR;
+		req.tp_frame_nr = (req.tp_block_size / req.tp_frame_size) * TX_RING_BLOCK_NR;
+		res = setsockopt(interfaces[intidx], SOL_PACKET, PACKET_TX_RING, &req,
+				 sizeof(req));
+		DIE(res == -1, "setsockopt PACKET_TX_RING");
+
+		tx->frame_size = req.tp_frame_size;
+		tx->frame_nr = req.tp_frame_nr;
+		tx->size = tx_size = (size_t)req.tp_block_size * req.tp_block_nr;
+		pthread_mutex_init(&tx->lock, NULL);
+	}
+
+	map = mmap(NULL, rx_size + tx_size, PROT_READ | PROT_WRITE,
+		   MAP_SHARED | MAP_LOCKED, interfaces[intidx], 0);
+	DIE(map == MAP_FAILED, "mmap packet rings");
+
+	if (rx_size)
+		rx->map = map;
+	if (tx_size)
+		tx->map = map + rx_size;
+}
+
+static inline struct tpacket_block_desc *rx_ring_block(struct rx_ring *ring,
+							unsigned int block)
+{
+	return (struct tpacket_block_desc *)(ring->map + (size_t)block * ring->block_size);
+}
+
+/* Walks the frames of the ready blocks of a ring, without copying them */
+static int rx_ring_walk(struct rx_ring *ring, int intidx, char **frames,
+			int *ifaces, size_t *lengths, int max_frames)
+{
+	struct tpacket_block_desc *bd;
+	int count = 0;
+
+	while (count < max_frames) {
+		bd = rx_ring_block(ring, ring->cur_block);
+
+		if (!ring->walking) {
+			/* Every block is either held by the caller or in use */
+			if (ring->held_nr == ring->block_nr)
+				break;
+			if (!(bd->hdr.bh1.block_status & TP_STATUS_USER))
+				break;
+			__sync_synchronize();
+
+			ring->walking = 1;
+			ring->pkt_left = bd->hdr.bh1.num_pkts;
+			ring->next_pkt = (struct tpacket3_hdr *)((uint8_t *)bd +
+					bd->hdr.bh1.offset_to_first_pkt);
+		}
+
+		if (ring->pkt_left == 0) {
+			/* The block is done, it is given back by ring_release */
+			ring->walking = 0;
+			if (ring->held_nr++ == 0)
+				held_rings[held_rings_nr++] = intidx;
+			ring->cur_block = (ring->cur_block + 1) % ring->block_nr;
+			continue;
+		}
+
+		/* A frame larger than the block room was cut: dropped */
+		if (ring->next_pkt->tp_snaplen < ring->next_pkt->tp_len) {
+			__atomic_add_fetch(&link_stats[intidx].rx_oversize, 1,
+					   __ATOMIC_RELAXED);
+		} else {
+			frames[count] = (char *)ring->next_pkt + ring->next_pkt->tp_mac;
+			lengths[count] = ring->next_pkt->tp_snaplen;
+			ifaces[count] = intidx;
+			count++;
+		}
+
+		ring->pkt_left--;
+		ring->next_pkt = (struct tpacket3_hdr *)((uint8_t *)ring->next_pkt +
+				ring->next_pkt->tp_next_offset);
+	}
+
+	return count;
+}
+
+int ring_recv_batch(char **frames, int *ifaces, size_t *lengths, int max_frames)
+{
+	int count = 0;
+	int intidx, walked;
+
+	if (max_frames > MAX_BATCH_LEN)
+		max_frames = MAX_BATCH_LEN;
+
+	/* Only the rings of the ready interfaces are walked, in turn, so a busy
+	 * one can't fill every batch. A ring that still has frames is reported
+	 * again by the next epoll_wait. */
+	while (count == 0 || (ready_next < ready_nr && count < max_frames)) {
+		intidx = next_ready_interface();
+		if (!rx_rings[intidx].map)
+			continue;
+
+		walked = rx_ring_walk(&rx_rings[intidx], intidx, frames + count,
+				      ifaces + count, lengths + count,
+				      max_frames - count);
+
+		/* Only the frames just walked go through the fast path; the ones
+		 * it punts follow those punted before. The frames it forwarded
+		 * are done with: if none is left for the caller, their blocks
+		 * are given back here, as the caller won't call ring_release */
+		if (walked > 0 && fastpath_enabled()) {
+			walked = fastpath_process(frames + count, ifaces + count,
+						  lengths + count, walked);
+			if (count + walked == 0)
+				ring_release();
+		}
+		count += walked;
+	}
+
+	return count;
+}
+
+int ring_recv_from_link(int intidx, char **frames, size_t *lengths, int max_frames)
+{
+	int ifaces[MAX_BATCH_LEN];
+	int count;
+
+	if (max_frames > MAX_BATCH_LEN)
+		max_frames = MAX_BATCH_LEN;
+
+	if (!rx_rings[intidx].map)
+		return 0;
+
+	count = rx_ring_walk(&rx_rings[intidx], intidx, frames, ifaces, lengths,
+			     max_frames);
+	if (count > 0 && fastpath_enabled()) {
+		count = fastpath_process(frames, ifaces, lengths, count);
+		if (count == 0)
+			ring_release();
+	}
+	return count;
+}
+
+void ring_release(void)
+{
+	struct rx_ring *ring;
+	unsigned int block;
+
+	for (int i = 0; i < held_rings_nr; i++) {
+		ring = &rx_rings[held_rings[i]];
+
+		block = (ring->cur_block + ring->block_nr - ring->held_nr) % ring->block_nr;
+		for (; ring->held_nr > 0; ring->held_nr--) {
+			__sync_synchronize();
+			rx_ring_block(ring, block)->hdr.bh1.block_status = TP_STATUS_KERNEL;
+			block = (block + 1) % ring->block_nr;
+		}
+	}
+	held_rings_nr = 0;
+}
+
+int get_rx_ring(int intidx, char **map, size_t *size)
+{
+	if (!rx_rings[intidx].map)
+		return -1;
+
+	*map = (char *)rx_rings[intidx].map;
+	*size = rx_rings[intidx].size;
+	return 0;
+}
+
+int set_interface_mtu(const char *name, int mtu)
+{
+	struct ifreq ifr;
+	int s, res;
+
+	s = socket(AF_INET, SOCK_DGRAM, 0);
+	if (s == -1)
+		return -errno;
+
+	memset(&ifr, 0, sizeof(ifr));
+	strncpy(ifr.ifr_name, name, IFNAMSIZ - 1);
+	ifr.ifr_mtu = mtu;
+	res = ioctl(s, SIOCSIFMTU, &ifr);
+	if (res == -1)
+		res = -errno;
+	close(s);
+	return res;
+}
+
+int get_interface_mtu(int intidx)
+{
+	return mtus[intidx];
+}
+
+size_t get_max_frame_len(void)
+{
+	return max_frame_len;
+}
+
+int get_link_stats(int intidx, struct link_stats *stats)
+{
+	if (intidx < 0 || intidx >= num_interfaces)
+		return -1;
+
+	stats->rx_oversize = __atomic_load_n(&link_stats[intidx].rx_oversize,
+					     __ATOMIC_RELAXED);
+	stats->tx_oversize = __atomic_load_n(&link_stats[intidx].tx_oversize,
+					     __ATOMIC_RELAXED);
+	stats->rx_errors = __atomic_load_n(&link_stats[intidx].rx_errors,
+					   __ATOMIC_RELAXED);
+	return 0;
+}
+
+/* Reads the MTU of the interface of a socket */
+static int read_mtu(int sockfd, const char *name)
+{
+	struct ifreq ifr;
+	int res;
+
+	memset(&ifr, 0, sizeof(ifr));
+	strncpy(ifr.ifr_name, name, IFNAMSIZ - 1);
+	res = ioctl(sockfd, SIOCGIFMTU, &ifr);
+	DIE(res == -1, "ioctl SIOCGIFMTU");
+	return ifr.ifr_mtu;
+}
+
+int init_backend(int argc, char *argv[], int backend)
+{
+	struct epoll_event ev;
+	int res;
+
+	rx_backend = backend & RX_BACKEND_RING;
+	tx_backend = backend & TX_BACKEND_RING;
+
+	num_interfaces = argc;
+	interfaces = calloc(argc, sizeof(*interfaces));
+	rx_rings = calloc(argc, sizeof(*rx_rings));
+	tx_rings = calloc(argc, sizeof(*tx_rings));
+	held_rings = calloc(argc, sizeof(*held_rings));
+	ready_events = calloc(argc, sizeof(*ready_events));
+	interface_names = calloc(argc, sizeof(*interface_names));
+	mtus = calloc(argc, sizeof(*mtus));
+	tx_limits = calloc(argc, sizeof(*tx_limits));
+	link_stats = calloc(argc, sizeof(*link_stats));
+	DIE(!interfaces || !interface_names || !rx_rings || !tx_rings ||
+	    !held_rings || !ready_events || !mtus || !tx_limits || !link_stats,
+	    "calloc");
+
+	epfd = epoll_create1(0);
+	DIE(epfd == -1, "epoll_create1");
+
+	/* The buffers are sized before any ring is set up */
+	for (int i = 0; i < argc; ++i) {
+		strncpy(interface_names[i], argv[i], IFNAMSIZ - 1);
 		interfaces[i] = get_sock(argv[i]);
+		mtus[i] = read_mtu(interfaces[i], argv[i]);
+		tx_limits[i] = mtus[i] + ETH_HEADER_LEN;
+		if (mtus[i] + ETH_HEADER_LEN + VLAN_TAG_LEN > max_frame_len)
+			max_frame_len = mtus[i] + ETH_HEADER_LEN + VLAN_TAG_LEN;
+	}
+
+	for (int i = 0; i < argc; ++i) {
+		printf("Setting up interface: %s\n", argv[i]);
+		if (rx_backend == RX_BACKEND_RING || tx_backend == TX_BACKEND_RING)
+			setup_rings(i);
+
+		memset(&ev, 0, sizeof(ev));
+		ev.events = EPOLLIN;
+		ev.data.u32 = i;
+		res = epoll_ctl(epfd, EPOLL_CTL_ADD, interfaces[i], &ev);
+		DIE(res == -1, "epoll_ctl");
+	}
+
+	return argc;
+}
+
+int set_rx_filter(const uint16_t *ethertypes, int count, int ignore_outgoing)
+{
+	struct sock_filter code[8 + 2 * RX_FILTER_MAX_ETHERTYPES];
+	struct sock_fprog prog;
+	int vlan, drop, accept;
+	int n = 0;
+	int res;
+
+	if (count < 0 || count > RX_FILTER_MAX_ETHERTYPES)
+		return -EINVAL;
+
+	/* Where the blocks start: the ethertypes after the VLAN tag, then the
+	 * verdicts */
+	vlan = 6 + count;
+	drop = vlan + 1 + count;
+	accept = drop + 1;
+
+	code[n++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_H | BPF_ABS, 12);
+	code[n] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, VLAN_TPID,
+					       vlan - n - 1, 0);
+	n++;
+	for (int i = 0; i < count; i++, n++)
+		code[n] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K,
+						       ethertypes[i], accept - n - 1, 0);
+
+	/* BPDUs have no ethertype, they are recognized by 01:80:c2:00:00:00 */
+	code[n++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_W | BPF_ABS, 0);
+	code[n] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, 0x0180c200,
+					       0, drop - n - 1);
+	n++;
+	code[n++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_H | BPF_ABS, 4);
+	code[n] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, 0,
+					       accept - n - 1, drop - n - 1);
+	n++;
+
+	code[n++] = (struct sock_filter)BPF_STMT(BPF_LD | BPF_H | BPF_ABS, 16);
+	for (int i = 0; i < count; i++, n++)
+		code[n] = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K,
+						       ethertypes[i], accept - n - 1, 0);
+
+	code[n++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, 0);
+	code[n++] = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, 0xffffffff);
+
+	prog.len = n;
+	prog.filter = code;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		if (count > 0) {
+			res = setsockopt(interfaces[i], SOL_SOCKET, SO_ATTACH_FILTER,
+					 &prog, sizeof(prog));
+			if (res == -1)
+				return -errno;
+		}
+
+		res = setsockopt(interfaces[i], SOL_PACKET, PACKET_IGNORE_OUTGOING,
+				 &ignore_outgoing, sizeof(ignore_outgoing));
+		if (res == -1)
+			return -errno;
 	}
 
-  return argc;
+	return 0;
+}
+
+int join_fanout(int group_id)
+{
+	int arg, one = 1;
+	int res;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		/* Frames sent by the other processes of the switch would be
+		 * received as well */
+		res = setsockopt(interfaces[i], SOL_PACKET, PACKET_IGNORE_OUTGOING,
+				 &one, sizeof(one));
+		if (res == -1)
+			return -errno;
+
+		/* A fanout group only holds sockets bound to the same device.
+		 * The group receives for its sockets, so it must ignore the
+		 * outgoing frames too */
+		arg = ((group_id + i) & 0xffff) |
+		      (PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_IGNORE_OUTGOING) << 16;
+		res = setsockopt(interfaces[i], SOL_PACKET, PACKET_FANOUT, &arg,
+				 sizeof(arg));
+		if (res == -1)
+			return -errno;
+	}
+
+	return 0;
+}
+
+int disable_rx(void)
+{
+	struct sock_filter drop_all[] = {
+		BPF_STMT(BPF_RET | BPF_K, 0),
+	};
+	struct sock_fprog prog = {
+		.len = 1,
+		.filter = drop_all,
+	};
+	int res;
+
+	for (int i = 0; i < num_interfaces; i++) {
+		res = setsockopt(interfaces[i], SOL_SOCKET, SO_ATTACH_FILTER, &prog,
+				 sizeof(prog));
+		if (res == -1)
+			return -errno;
+	}
+
+	return 0;
+}
+
+int init(int argc, char *argv[])
+{
+	return init_backend(argc, argv, RX_BACKEND_SOCKET);
 }
@@ -4,230 +4,1390 @@ import struct
 import wrapper
 import threading
 import time
-from wrapper import recv_from_any_link, send_to_link, get_switch_mac, get_interface_name
+import asyncio
+import os
+import multiprocessing
+import signal
+import ctypes
+import atexit
+import collections
+import queue
+from wrapper import recv_from_any_link, send_to_link, send_batch, FramePool, RxRing, get_switch_mac, get_interface_name
+
+# Maximum number of frames handled per main loop iteration
+BATCH_SIZE = 32
+
+# How frames are received: wrapper.RX_BACKEND_SOCKET or wrapper.RX_BACKEND_RING
+RX_BACKEND = wrapper.RX_BACKEND_SOCKET
+# How frames are sent: wrapper.TX_BACKEND_SOCKET or wrapper.TX_BACKEND_RING
+TX_BACKEND = wrapper.TX_BACKEND_SOCKET
+
+# Frames waiting to be sent on each port; 0 sends from the receive loop
+# itself. A full queue drops the new frame (EGRESS_DROP_TAIL) or its oldest
+# one (EGRESS_DROP_HEAD).
+EGRESS_QUEUE_LEN = 256
+EGRESS_DROP = wrapper.EGRESS_DROP_TAIL
+
+# Forward the frames to known unicast destinations in dlink.so, without going
+# through Python. Single process mode only (NUM_WORKERS = 1).
+FAST_PATH = True
+
+# Ethertypes switched; frames of other ethertypes are dropped by the kernel
+# before they reach Python. BPDUs are always received. IPv6 (0x86dd) is
+# disabled in the topology.
+SWITCHED_ETHERTYPES = (0x0800, 0x0806)
+
+# MAC table: entries not seen for MAC_AGING_TIME seconds are removed, and
+# when MAC_TABLE_SIZE MACs are known the least recently seen one makes room.
+# The time a MAC was seen is only updated once every MAC_REFRESH seconds.
+# Aging runs with the frames Python receives; the sources of the frames
+# forwarded by the fast path are refreshed from its hits once a second.
+# With workers, the table is shared and holds 4096 MACs (FDB_SIZE); the
+# control plane ages it every MAC_REFRESH seconds.
+MAC_AGING_TIME = 300
+MAC_TABLE_SIZE = 4096
+MAC_REFRESH = 1
+# Aged entries removed at most per received batch
+MAC_EXPIRE_BATCH = 16
+
+# Number of microflows whose actions are kept ready to send
+MICROFLOW_CACHE_SIZE = 4096
+
+# IGMP snooping: IP multicast is only sent to the ports that joined its group
+# and to the multicast router ports (where IGMP queries come from, or set with
+# igmp-router=yes on the port line of the config file). Frames of groups no
+# port joined are flooded, or only sent to the router ports if
+# IGMP_FLOOD_UNREGISTERED is False. IGMP queries are flooded; reports and
+# leaves are sent to the router ports and over the trunks, so that the
+# switches behind learn of the members. Single process mode only.
+IGMP_SNOOPING = True
+IGMP_FLOOD_UNREGISTERED = True
+# Seconds a membership or router port lasts without being refreshed
+IGMP_MEMBERSHIP_TIME = 260
+IGMP_ROUTER_TIME = 260
+
+# ARP suppression: the IP -> MAC bindings of the senders of the ARP requests
+# and replies are cached, and the requests for a cached IP are not flooded.
+# ARP frames are never forwarded by the fast path, so that every binding is
+# seen. The requests are sent as unicast to the port of the MAC (ARP_UNICAST),
+# so the host still answers itself, or answered by the switch (ARP_REPLY).
+# ARP_OFF floods them.
+ARP_OFF = 0
+ARP_UNICAST = 1
+ARP_REPLY = 2
+ARP_SUPPRESSION = ARP_UNICAST
+ARP_CACHE_SIZE = 4096
+# Seconds a binding is used without being seen again
+ARP_CACHE_TIME = 300
+
+# Link aggregation: the trunks with the same lag=<n> on their config line
+#   rr-0-1 T lag=1
+#   rr-0-2 T lag=1
+# form one logical port, their first one. STP, the MAC table and the flows
+# only see the logical port. A frame sent to it goes on one of its members
+# whose link is up, picked by a hash of its MACs and VLAN (LAG_HASH_L2), and
+# of its IPv4 addresses and TCP/UDP ports (LAG_HASH_L3L4), so the frames of a
+# flow stay in order. The links are checked every LAG_LINK_CHECK seconds.
+LAG_HASH_L2 = 0
+LAG_HASH_L3L4 = 1
+LAG_HASH = LAG_HASH_L2
+LAG_LINK_CHECK = 1
+
+# False: blocking receive loop, with the BPDU timer in its own thread.
+# True: every port and the BPDU timer on one asyncio event loop.
+ASYNCIO_DATAPATH = False
+
+# Number of forwarding processes. With more than one, the frames of every
+# port are spread over the workers (PACKET_FANOUT) and the MAC table and STP
+# states live in shared memory, written only by the control plane process.
+NUM_WORKERS = 1
+
+# What is traced: nothing (TRACE_OFF), the control events (TRACE_CONTROL:
+# BPDUs, new and moved MACs) or every frame too (TRACE_FRAMES), 1 in
+# TRACE_SAMPLE of them. Frames forwarded by the fast path never reach Python
+# and are not traced. The last TRACE_RING_SIZE records are printed on SIGUSR1
+# and when the switch exits.
+TRACE_OFF = 0
+TRACE_CONTROL = 1
+TRACE_FRAMES = 2
+TRACE_LEVEL = TRACE_CONTROL
+TRACE_SAMPLE = 1
+TRACE_RING_SIZE = 4096
+
+# BPDUs: the MACs, root bridge id, path cost and sender bridge id are
+# followed by the BPDU type and the 802.1D flags
+BPDU_CONFIG = 0x00
+BPDU_TCN = 0x80 # topology change notification, sent towards the root
+BPDU_TC = 0x01 # topology change, set by the root
+BPDU_TCA = 0x80 # topology change notification acknowledged
+# Seconds the root keeps BPDU_TC set in its hello BPDUs after a change
+TC_TIME = 2
+
+# Messages sent by the workers to the control plane
+CTRL_LEARN = 0 # (CTRL_LEARN, MAC table key, interface)
+CTRL_BPDU = 1 # (CTRL_BPDU, interface, frame)
+
+# The MACs are read as 48-bit integers (high 16 bits, low 32 bits), straight
+# from the frame buffer
+ETHERNET_HEADER = struct.Struct('!HIHIH')
+VLAN_TAG = struct.Struct('!HH')
 
 def parse_ethernet_header(data):
-    # Unpack the header fields from the byte array
-    #dest_mac, src_mac, ethertype = struct.unpack('!6s6sH', data[:14])
-    dest_mac = data[0:6]
-    src_mac = data[6:12]
-    
-    # Extract ethertype. Under 802.1Q, this may be the bytes from the VLAN TAG
-    ether_type = (data[12] << 8) + data[13]
+    # Unpack the header fields from the byte array, without slicing it
+    dest_hi, dest_lo, src_hi, src_lo, ether_type = ETHERNET_HEADER.unpack_from(data)
+    dest_mac = dest_hi << 32 | dest_lo
+    src_mac = src_hi << 32 | src_lo
 
     vlan_id = -1
-    # Check for VLAN tag (0x8100 in network byte order is b'\x81\x00')
+    # Check for VLAN tag. Under 802.1Q, ether_type is the TPID of the tag
     if ether_type == 0x8200:
-        vlan_tci = int.from_bytes(data[14:16], byteorder='big')
+        vlan_tci, ether_type = VLAN_TAG.unpack_from(data, 14)
         vlan_id = vlan_tci & 0x0FFF  # extract the 12-bit VLAN ID
-        ether_type = (data[16] << 8) + data[17]
 
     return dest_mac, src_mac, ether_type, vlan_id
 
+# The MAC table key of a MAC learnt in a VLAN. Untagged frames on trunks (-1)
+# get VLAN 0xFFF.
+def fdb_key(vlan_id, mac):
+    return (vlan_id & 0x0FFF) << 48 | mac
+
 def create_vlan_tag(vlan_id):
     # 0x8100 for the Ethertype for 802.1Q
     # vlan_id & 0x0FFF ensures that only the last 12 bits are used
     return struct.pack('!H', 0x8200) + struct.pack('!H', vlan_id & 0x0FFF)
 
-def create_bpdu(src_mac, root_bridge_id, sender_path_cost, own_bridge_id):
+def create_bpdu(src_mac, root_bridge_id, sender_path_cost, own_bridge_id, flags=0, bpdu_type=BPDU_CONFIG):
     bpdu_mac = bytes([0x01, 0x80, 0xc2, 0x00, 0x00, 0x00])
-    return bpdu_mac + src_mac + struct.pack('!H', root_bridge_id) + struct.pack('!H', sender_path_cost) + struct.pack('!H', own_bridge_id)
+    return bpdu_mac + src_mac + struct.pack('!H', root_bridge_id) + struct.pack('!H', sender_path_cost) + struct.pack('!H', own_bridge_id) + struct.pack('!BB', bpdu_type, flags)
 
-def send_bdpu_every_sec(stp, own_bridge_id, root_bridge_id, vlan_ids, priority, interfaces):
-    while True:
-        for i in interfaces:
-            if vlan_ids[i] == -1: # Send on trunk
-                root_bridge_id = own_bridge_id
-                sender_path_cost = 0
-                sender_bridge_id = own_bridge_id
-                bpdu = create_bpdu(get_switch_mac(), root_bridge_id, sender_path_cost, sender_bridge_id)
-                send_to_link(i, bpdu, 18)
+def create_tcn_bpdu(sw):
+    return create_bpdu(sw.switch_mac, sw.root_bridge_id, sw.root_path_cost, sw.own_bridge_id, 0, BPDU_TCN)
+
+# Hello BPDUs are sent on the trunks by the root bridge only. The other
+# bridges repeat their topology change notification until it is acknowledged.
+def send_hello_bpdus(sw):
+    if sw.own_bridge_id != sw.root_bridge_id:
+        if sw.tcn_pending:
+            tcn = create_tcn_bpdu(sw)
+            for i in sw.trunk_ports:
+                if sw.stp[i] == 2: # Root port
+                    send_to_link(sw.lag.failover.get(i, i), tcn, len(tcn))
+        return
 
+    root_bridge_id = sw.own_bridge_id
+    sender_path_cost = 0
+    sender_bridge_id = sw.own_bridge_id
+    flags = BPDU_TC if time.monotonic() < sw.tc_until else 0
+    bpdu = create_bpdu(sw.switch_mac, root_bridge_id, sender_path_cost, sender_bridge_id, flags)
+    for i in sw.trunk_ports: # Send on trunk
+        send_to_link(sw.lag.failover.get(i, i), bpdu, len(bpdu))
+
+def send_bdpu_every_sec(sw):
+    while True:
+        send_hello_bpdus(sw)
+        sw.lag.poll(time.monotonic())
         time.sleep(1)
 
+BPDU_MAC = 0x0180C2000000
+
 def isunicast(mac):
-    return (mac[0] & 0x01) == 0
+    return (mac >> 40) & 0x01 == 0
 
 def readCfgFile(switch_id):
     file = open("./configs/switch"+str(switch_id)+".cfg", "r")
     lines = file.readline()
     priority = int(lines)
     interfaces = []
-    for i in range(4):
-        lines = file.readline()
-        list = lines.split(" ")
-        if list[1].strip() == 'T':
+    port_options = []
+    # One line per port, in interface order, for any number of ports
+    for lines in file:
+        list = lines.split()
+        if len(list) < 2:
+            continue
+        if list[1] == 'T':
             interfaces.append(-1)
         else:
-            interfaces.append(int(list[1].strip()))
-    return priority, interfaces
+            interfaces.append(int(list[1]))
+        # Optional name=value settings may follow the VLAN
+        port_options.append(dict(option.split('=', 1) for option in list[2:]))
+    file.close()
+    return priority, interfaces, port_options
+
+# The MTUs set on the port lines of the config file, after the VLAN:
+#   rr-0-1 T mtu=9004
+# None keeps the MTU of the kernel. Trunks carry the frames of the access
+# ports with a VLAN tag: they need an MTU 4 bytes larger, or the largest
+# frames are dropped (counted in wrapper.get_link_stats).
+def port_mtus(port_options):
+    return [int(options['mtu']) if 'mtu' in options else None for options in port_options]
+
+# Groups the ports by role: the access ports of every VLAN and the trunks.
+# Frames are only flooded to the ports of their VLAN and to the trunks, so the
+# cost of a flood doesn't grow with the ports of other VLANs. The members of a
+# link aggregation group are behind their logical port (logical_ports[i]).
+def getPortLists(vlan_ids, logical_ports=None):
+    access_ports = {}
+    trunk_ports = []
+    for i, vlan in enumerate(vlan_ids):
+        if logical_ports is not None and logical_ports[i] != i:
+            continue
+        if vlan == -1:
+            trunk_ports.append(i)
+        else:
+            access_ports.setdefault(vlan, []).append(i)
+    return access_ports, trunk_ports
 
 def initSTP(interfaces, priority):
-    stp = []
-    for i in interfaces:
-        if interfaces[i] == -1: # Block trunk
-            stp.append(-1)
-        else: # Set other interfaces to nothing
-            stp.append(0)
     root_bridge_id = priority
     own_bridge_id = priority
     root_path_cost = 0
 
-    for i in interfaces:
-        stp[i] = 1 # Designated
+    # Every switch starts as the root bridge, so every port is designated
+    stp = [1] * len(interfaces)
     
     return stp, own_bridge_id, root_bridge_id, root_path_cost
     
 
+# What is done to a frame sent on an egress port
+FWD_AS_IS = 0
+FWD_TAG = 1 # access -> trunk: push the tag of the frame's VLAN
+FWD_UNTAG = 2 # trunk -> access: pop the tag
+
+# The egress ports of the frames received on each port for each VLAN, with
+# what to do to the frames, compiled from the port VLANs and STP states.
+# Entries are compiled the first time they are needed, and dropped by
+# rebuild() when the STP states change.
+class ForwardingTable:
+    def __init__(self, sw):
+        self.sw = sw
+        self.rebuild()
+
+    def rebuild(self):
+        # (ingress port, VLAN) -> {egress port: action}
+        self.actions = {}
+        # (ingress port, VLAN) -> [(egress port, action)], without the ingress port
+        self.floods = {}
+        self.generation = getattr(self.sw.stp, 'generation', None)
+        # The cached microflows went through the old entries
+        self.sw.flows.invalidate()
+
+    # Rebuilds the table if the STP states were changed by another process
+    def sync(self):
+        if self.sw.stp.generation != self.generation:
+            self.rebuild()
+
+    def _compile(self, interface, vlan):
+        vlan_ids = self.sw.vlan_ids
+        stp = self.sw.stp
+        actions = {}
+        # Only the ports of the frame's VLAN and the trunks can get it
+        for i in self.sw.access_ports.get(vlan, []) + self.sw.trunk_ports:
+            if vlan_ids[interface] != -1: # Host
+                if vlan_ids[i] != -1: # Host->Host
+                    actions[i] = FWD_AS_IS
+                else: # Host->Switch
+                    actions[i] = FWD_TAG
+            else: # Switch
+                if vlan_ids[i] == -1: # Switch->Switch
+                    if stp[i] != -1:
+                        actions[i] = FWD_AS_IS
+                else: # Switch->Host
+                    actions[i] = FWD_UNTAG
+
+        self.actions[(interface, vlan)] = actions
+        self.floods[(interface, vlan)] = [(i, action) for i, action in actions.items() if i != interface]
+
+    # Returns {egress port: action} for a frame of a VLAN received on a port
+    def egress(self, interface, vlan):
+        key = (interface, vlan)
+        if key not in self.actions:
+            self._compile(interface, vlan)
+        return self.actions[key]
+
+    # Returns [(egress port, action)] to flood a frame of a VLAN received on
+    # a port
+    def flood(self, interface, vlan):
+        key = (interface, vlan)
+        if key not in self.floods:
+            self._compile(interface, vlan)
+        return self.floods[key]
+
+# Ready-to-send actions: (egress port, bytes put after the MACs, where the
+# rest of the frame starts). The bytes are the 802.1Q header pushed, if any.
+def compile_actions(egress, vlan):
+    actions = []
+    for i, action in egress:
+        if action == FWD_AS_IS:
+            actions.append((i, None, 0))
+        elif action == FWD_TAG:
+            actions.append((i, create_vlan_tag(vlan), 12))
+        else:
+            actions.append((i, b'', 16))
+    return actions
+
+# The final actions of the microflows, (ingress port, fdb_key(VLAN, destination)),
+# so that the next frames of a flow are sent without going through the
+# forwarding rules again. The flows to unknown destinations are not cached,
+# they change as soon as the destination is learnt. Everything is dropped
+# (the generation changes) when a MAC moves or the STP states change. The
+# oldest flows are evicted when the cache is full.
+class MicroflowCache:
+    def __init__(self, size=MICROFLOW_CACHE_SIZE):
+        self.size = size
+        # (ingress port, destination key) -> (generation, actions)
+        self.flows = {}
+        self.generation = 0
+        # Generation of the shared MAC table last seen, for workers only
+        self.mac_generation = None
+
+    def invalidate(self):
+        self.generation += 1
+
+    # Invalidates the cache if MACs were moved by another process
+    def sync(self, mac_generation):
+        if mac_generation != self.mac_generation:
+            self.mac_generation = mac_generation
+            self.invalidate()
+
+    def get(self, key):
+        entry = self.flows.get(key)
+        if entry is not None and entry[0] == self.generation:
+            return entry[1]
+        return None
+
+    def put(self, key, actions):
+        if key not in self.flows and len(self.flows) >= self.size:
+            # Dicts keep the insertion order: the first key is the oldest
+            del self.flows[next(iter(self.flows))]
+        self.flows[key] = (self.generation, actions)
+
+# The MAC table of a single process switch, keyed by fdb_key(VLAN, MAC): a
+# MAC is learnt independently in every VLAN. An entry is a single integer,
+# the time the key was last seen (in seconds) << 16 | the port. The entries
+# are kept from the least to the most recently seen, so the aged and evicted
+# ones are always at the front and expiring never scans the table.
+class MACTable:
+    def __init__(self, on_forget=None, size=MAC_TABLE_SIZE, aging_time=MAC_AGING_TIME):
+        self.size = size
+        self.aging_time = aging_time
+        # Called with every key removed
+        self.on_forget = on_forget
+        self.entries = collections.OrderedDict()
+        # VLAN -> number of entries
+        self.vlan_counts = {}
+        # Time of the frames being processed, set by tick()
+        self.now = int(time.monotonic())
+        # Returns the keys of the MACs seen by the fast path since the last
+        # call (FastPath.hits), or None
+        self.hits = None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key] & 0xFFFF
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        return default if entry is None else entry & 0xFFFF
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Learns a source MAC; returns the port it was on before, or None. A MAC
+    # seen again on the same port is not written, unless its time is old.
+    def learn(self, key, interface):
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) >= self.size:
+                self._remove(next(iter(self.entries)))
+            self.entries[key] = self.now << 16 | interface
+            vlan = key >> 48
+            self.vlan_counts[vlan] = self.vlan_counts.get(vlan, 0) + 1
+            return None
+
+        known = entry & 0xFFFF
+        if known != interface or self.now - (entry >> 16) >= MAC_REFRESH:
+            self.entries[key] = self.now << 16 | interface
+            self.entries.move_to_end(key)
+        return known
+
+    # Called once per received batch: sets the time and removes a few aged
+    # entries. Once a second, the MACs the fast path forwarded frames from
+    # are refreshed first.
+    def tick(self, now):
+        now = int(now)
+        if now != self.now and self.hits is not None:
+            self.now = now
+            for key in self.hits():
+                self.refresh(key)
+        self.now = now
+        oldest = self.now - self.aging_time
+        for _ in range(MAC_EXPIRE_BATCH):
+            if not self.entries:
+                break
+            key = next(iter(self.entries))
+            if self.entries[key] >> 16 > oldest:
+                break
+            self._remove(key)
+
+    # Marks a known MAC as seen now. It moves to the end, as aging expects
+    # the oldest entries at the front.
+    def refresh(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.now - (entry >> 16) >= MAC_REFRESH:
+            self.entries[key] = self.now << 16 | entry & 0xFFFF
+            self.entries.move_to_end(key)
+
+    # Number of MACs learnt in a VLAN
+    def count(self, vlan):
+        return self.vlan_counts.get(vlan & 0x0FFF, 0)
+
+    # Removes the entries of a VLAN, of a port, or both
+    def flush(self, vlan=None, interface=None):
+        for key, entry in list(self.entries.items()):
+            if vlan is not None and key >> 48 != vlan & 0x0FFF:
+                continue
+            if interface is not None and entry & 0xFFFF != interface:
+                continue
+            self._remove(key)
+
+    def _remove(self, key):
+        del self.entries[key]
+        vlan = key >> 48
+        self.vlan_counts[vlan] -= 1
+        if self.vlan_counts[vlan] == 0:
+            del self.vlan_counts[vlan]
+        if self.on_forget is not None:
+            self.on_forget(key)
+
+# Storm control: the broadcast, multicast and unknown unicast frames a port
+# may flood, limited in frames and bits per second per traffic class. Set on
+# the port lines of the config file, after the VLAN:
+#   r-0 1 broadcast=100pps multicast=1000pps,8000000bps unknown-unicast=200pps
+# Each limit is a token bucket holding one second of traffic. The frames
+# over the limit are dropped before being copied to the flood ports.
+STORM_BROADCAST = 0
+STORM_MULTICAST = 1
+STORM_UNKNOWN_UNICAST = 2
+STORM_CLASSES = ('broadcast', 'multicast', 'unknown-unicast')
+
+BROADCAST_MAC = 0xFFFFFFFFFFFF
+
+class StormControl:
+    # share: the part of the limits enforced here, as every worker only sees
+    # some of the frames of a port
+    def __init__(self, port_options, share=1):
+        # Per port: a bucket per class (None: not limited), or None when the
+        # port has no limit at all
+        self.buckets = []
+        # Per port: frames dropped per class
+        self.dropped = []
+        for options in port_options:
+            buckets = [self._bucket(options.get(name), share) for name in STORM_CLASSES]
+            self.buckets.append(buckets if any(buckets) else None)
+            self.dropped.append([0] * len(STORM_CLASSES))
+
+    # A limit is '<n>pps', '<n>bps' or both, separated by a comma. A bucket
+    # is [frames per second, bits per second, frame tokens, bit tokens,
+    # time of the last refill], a rate of 0 is not limited.
+    @staticmethod
+    def _bucket(limit, share):
+        if limit is None:
+            return None
+        pps = bps = 0
+        for rate in limit.split(','):
+            if rate.endswith('pps'):
+                pps = int(rate[:-3]) / share
+            elif rate.endswith('bps'):
+                bps = int(rate[:-3]) / share
+            else:
+                raise ValueError("storm control limit: " + limit)
+        return [pps, bps, pps, bps, time.monotonic()]
+
+    # Called for every frame about to be flooded; False if it is to be
+    # dropped
+    def admit(self, interface, dest_mac, length):
+        if interface >= len(self.buckets) or self.buckets[interface] is None:
+            return True
+
+        if dest_mac == BROADCAST_MAC:
+            storm_class = STORM_BROADCAST
+        elif not isunicast(dest_mac):
+            storm_class = STORM_MULTICAST
+        else:
+            storm_class = STORM_UNKNOWN_UNICAST
+        bucket = self.buckets[interface][storm_class]
+        if bucket is None:
+            return True
+
+        pps, bps, frames, bits, last = bucket
+        now = time.monotonic()
+        frames = min(pps, frames + (now - last) * pps)
+        bits = min(bps, bits + (now - last) * bps)
+        bucket[2], bucket[3], bucket[4] = frames, bits, now
+        if (pps and frames < 1) or (bps and bits < length * 8):
+            self.dropped[interface][storm_class] += 1
+            return False
+
+        bucket[2], bucket[3] = frames - 1, bits - length * 8
+        return True
+
+# IGMP messages
+IGMP_QUERY = 0x11
+IGMPV1_REPORT = 0x12
+IGMPV2_REPORT = 0x16
+IGMPV2_LEAVE = 0x17
+IGMPV3_REPORT = 0x22
+# IGMPv3 group record types
+IGMPV3_MODE_IS_INCLUDE = 1
+IGMPV3_MODE_IS_EXCLUDE = 2
+IGMPV3_CHANGE_TO_INCLUDE = 3
+IGMPV3_CHANGE_TO_EXCLUDE = 4
+IGMPV3_ALLOW_NEW_SOURCES = 5
+
+# 01:00:5e + the low 23 bits of the IPv4 group
+IPV4_MULTICAST_MAC = 0x01005E000000
+
+# The members of the IP multicast groups of every VLAN, learnt from the IGMP
+# reports and leaves. Groups are kept by MAC: the 32 groups sharing a MAC
+# share their members. The methods that change where frames go return True.
+class IGMPSnooping:
+    def __init__(self, port_options=(), flood_unregistered=IGMP_FLOOD_UNREGISTERED):
+        self.flood_unregistered = flood_unregistered
+        # fdb_key(VLAN, group MAC) -> {port: expiry time}
+        self.groups = {}
+        # VLAN -> {port: expiry time}
+        self.routers = {}
+        self.static_routers = {i for i, options in enumerate(port_options)
+                               if options.get('igmp-router') == 'yes'}
+        self.next_expiry = 0
+
+    # The type of the IGMP message of an IPv4 frame, or None if it carries
+    # none; ip is the offset of the IP header
+    @staticmethod
+    def message_type(data, ip):
+        if len(data) < ip + 20 or data[ip + 9] != 2: # Not IGMP
+            return None
+        igmp = ip + (data[ip] & 0x0F) * 4
+        if len(data) < igmp + 8:
+            return None
+        return data[igmp]
+
+    # Reads the IGMP message of an IPv4 frame sent to a multicast MAC; ip is
+    # the offset of the IP header
+    def snoop(self, data, ip, interface, vlan):
+        msg_type = self.message_type(data, ip)
+        if msg_type is None:
+            return False
+        igmp = ip + (data[ip] & 0x0F) * 4
+
+        now = time.monotonic()
+        if msg_type == IGMP_QUERY:
+            routers = self.routers.setdefault(vlan, {})
+            changed = interface not in routers
+            routers[interface] = now + IGMP_ROUTER_TIME
+            return changed
+        if msg_type in (IGMPV1_REPORT, IGMPV2_REPORT):
+            return self._join(vlan, data[igmp + 4:igmp + 8], interface, now)
+        if msg_type == IGMPV2_LEAVE:
+            return self._leave(vlan, data[igmp + 4:igmp + 8], interface)
+        if msg_type != IGMPV3_REPORT:
+            return False
+
+        changed = False
+        records = int.from_bytes(data[igmp + 6:igmp + 8], byteorder='big')
+        record = igmp + 8
+        for _ in range(records):
+            if len(data) < record + 8:
+                break
+            record_type = data[record]
+            sources = int.from_bytes(data[record + 2:record + 4], byteorder='big')
+            group = data[record + 4:record + 8]
+            # Excluding sources, or including some: the port wants the group.
+            # Including none: it leaves.
+            if record_type in (IGMPV3_MODE_IS_EXCLUDE, IGMPV3_CHANGE_TO_EXCLUDE):
+                changed |= self._join(vlan, group, interface, now)
+            elif record_type in (IGMPV3_MODE_IS_INCLUDE, IGMPV3_CHANGE_TO_INCLUDE, IGMPV3_ALLOW_NEW_SOURCES):
+                if sources > 0:
+                    changed |= self._join(vlan, group, interface, now)
+                elif record_type != IGMPV3_ALLOW_NEW_SOURCES:
+                    changed |= self._leave(vlan, group, interface)
+            record += 8 + 4 * sources + 4 * data[record + 1]
+        return changed
+
+    @staticmethod
+    def _group_key(vlan, group):
+        return fdb_key(vlan, IPV4_MULTICAST_MAC | int.from_bytes(group, byteorder='big') & 0x7FFFFF)
+
+    def _join(self, vlan, group, interface, now):
+        members = self.groups.setdefault(self._group_key(vlan, group), {})
+        changed = interface not in members
+        members[interface] = now + IGMP_MEMBERSHIP_TIME
+        return changed
+
+    # The port stops getting the group at once: the switch doesn't send the
+    # group specific query that would find other members behind the port
+    def _leave(self, vlan, group, interface):
+        key = self._group_key(vlan, group)
+        members = self.groups.get(key)
+        if members is None or interface not in members:
+            return False
+        del members[interface]
+        if not members:
+            del self.groups[key]
+        return True
+
+    # Called once per received batch; removes the expired memberships and
+    # router ports, once a second at most
+    def tick(self, now):
+        if now < self.next_expiry:
+            return False
+        self.next_expiry = now + 1
+
+        changed = False
+        for table in (self.groups, self.routers):
+            for key, ports in list(table.items()):
+                for i, expiry in list(ports.items()):
+                    if expiry <= now:
+                        del ports[i]
+                        changed = True
+                if not ports:
+                    del table[key]
+        return changed
+
+    # The flood ports an IGMP message goes to, whatever the group state.
+    # Queries go everywhere. Reports and leaves go to the router ports and
+    # over the trunks, so that the switches behind the trunks learn that
+    # they have members; not to the other hosts, which would then hold back
+    # their own reports.
+    def control_filter(self, vlan, msg_type, egress, trunk_ports):
+        if msg_type == IGMP_QUERY:
+            return egress
+        routers = self.routers.get(vlan, ())
+        return [(i, action) for i, action in egress
+                if i in trunk_ports or i in routers or i in self.static_routers]
+
+    # The flood ports a multicast frame goes to: all of them, unless it is IP
+    # multicast outside 224.0.0.x (always flooded), which only goes to the
+    # members of its group and the router ports
+    def filter(self, vlan, dest_mac, egress):
+        if dest_mac & ~0x7FFFFF != IPV4_MULTICAST_MAC or dest_mac & 0x7FFFFF <= 0xFF:
+            return egress
+
+        members = self.groups.get(fdb_key(vlan, dest_mac))
+        if members is None:
+            if self.flood_unregistered:
+                return egress
+            members = ()
+        routers = self.routers.get(vlan, ())
+        return [(i, action) for i, action in egress
+                if i in members or i in routers or i in self.static_routers]
+
+# ARP operations
+ARP_OP_REQUEST = 1
+ARP_OP_REPLY = 2
+# Ethernet / IPv4 ARP: htype, ptype, hlen, plen, oper, sha, spa, tha, tpa
+ARP_PACKET = struct.Struct('!HHBBH6s4s6s4s')
+
+# IPv4 -> MAC bindings per VLAN, from the senders of the ARP requests and
+# replies.
+# The oldest binding makes room when the cache is full.
+class ARPCache:
+    def __init__(self, size=ARP_CACHE_SIZE, aging_time=ARP_CACHE_TIME):
+        self.size = size
+        self.aging_time = aging_time
+        # VLAN << 32 | IP -> (MAC (6 bytes), expiry time)
+        self.bindings = collections.OrderedDict()
+
+    def learn(self, vlan, ip, mac):
+        key = (vlan & 0x0FFF) << 32 | int.from_bytes(ip, byteorder='big')
+        if key in self.bindings:
+            self.bindings.move_to_end(key)
+        elif len(self.bindings) >= self.size:
+            self.bindings.popitem(last=False)
+        self.bindings[key] = (mac, time.monotonic() + self.aging_time)
+
+    # Returns the MAC of an IP, or None
+    def get(self, vlan, ip):
+        key = (vlan & 0x0FFF) << 32 | int.from_bytes(ip, byteorder='big')
+        binding = self.bindings.get(key)
+        if binding is None:
+            return None
+        if binding[1] <= time.monotonic():
+            del self.bindings[key]
+            return None
+        return binding[0]
+
+# The member of a link aggregation group a frame goes on: the same hash in
+# the fast path (fastpath_lag_hash), so a flow doesn't change member when its
+# frames stop being punted. ip is the offset of the IP header.
+def lag_hash(dest_mac, src_mac, vlan, ethertype, data, ip, l3l4):
+    x = dest_mac ^ src_mac ^ (vlan & 0x0FFF)
+    if l3l4 and ethertype == 0x0800 and len(data) >= ip + 20:
+        x ^= int.from_bytes(data[ip + 12:ip + 16], byteorder='big') << 16 ^ \
+             int.from_bytes(data[ip + 16:ip + 20], byteorder='big')
+        # Fragments after the first have no ports: none are used
+        l4 = ip + (data[ip] & 0x0F) * 4
+        if data[ip + 9] in (6, 17) and int.from_bytes(data[ip + 6:ip + 8], byteorder='big') & 0x3FFF == 0 \
+                and len(data) >= l4 + 4:
+            x ^= int.from_bytes(data[l4:l4 + 4], byteorder='big') << 24
+    # The low bits of the product only depend on the low bits of x
+    x ^= x >> 32
+    return (x * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> 32
+
+# The link aggregation groups of the lag=<n> port options. Only trunks can be
+# aggregated.
+class LinkAggregation:
+    def __init__(self, vlan_ids=(), port_options=(), hash_mode=LAG_HASH):
+        self.l3l4 = hash_mode == LAG_HASH_L3L4
+        # Per port: its logical port, the first member of its group
+        self.logical = list(range(len(vlan_ids)))
+        # Logical port -> its members
+        self.members = {}
+        groups = {}
+        for i, options in enumerate(port_options):
+            lag = options.get('lag')
+            if lag is None:
+                continue
+            if vlan_ids[i] != -1:
+                raise ValueError("lag={}: port {} is not a trunk".format(lag, i))
+            groups.setdefault(lag, []).append(i)
+        for members in groups.values():
+            for i in members:
+                self.logical[i] = members[0]
+            self.members[members[0]] = tuple(members)
+        # Logical port -> its members whose link is up
+        self.active = dict(self.members)
+        # Logical port whose first member is down -> the member the frames
+        # sent to the logical port itself (BPDUs) go on
+        self.failover = {}
+        self.next_check = 0
+        # wrapper.FastPath, told when the active members change
+        self.fast_path = None
+
+    def set_fast_path(self, fast_path):
+        self.fast_path = fast_path
+        for port, active in self.active.items():
+            fast_path.set_lag(port, active, self.l3l4)
+
+    # The member a frame sent to a logical port goes on
+    def select(self, port, h):
+        active = self.active[port]
+        return active[h % len(active)] if active else port
+
+    # Called with the hello BPDUs (once per received batch in the workers);
+    # checks the member links, once every LAG_LINK_CHECK seconds at most.
+    # The frames of a failed member are rehashed over the others.
+    def poll(self, now):
+        if not self.members or now < self.next_check:
+            return
+        self.next_check = now + LAG_LINK_CHECK
+
+        # Replaced, not changed, as the datapath reads them meanwhile
+        actives = {}
+        failover = {}
+        for port, members in self.members.items():
+            active = tuple(i for i in members if wrapper.link_is_up(i))
+            actives[port] = active
+            if active and active[0] != port:
+                failover[port] = active[0]
+            if active != self.active[port] and self.fast_path is not None:
+                self.fast_path.set_lag(port, active, self.l3l4)
+        self.active = actives
+        self.failover = failover
+
+    # Moves the frames sent to a logical port whose first member is down
+    def redirect(self, tx_frames):
+        failover = self.failover
+        if not failover:
+            return
+        for n, frame in enumerate(tx_frames):
+            port = failover.get(frame[0])
+            if port is not None:
+                tx_frames[n] = (port,) + frame[1:]
+
+# Trace records: what was decided for a frame
+TRACE_FORWARD = 0
+TRACE_FLOOD = 1
+TRACE_DROP = 2
+TRACE_BPDU = 3
+TRACE_LEARN = 4
+TRACE_MOVE = 5
+TRACE_STORM = 6
+TRACE_NAMES = ('forward', 'flood', 'drop', 'bpdu', 'learn', 'move', 'storm')
+
+# Fixed-size binary records in a preallocated ring, overwritten when it is
+# full: (time, port, destination MAC, source MAC, ethertype, VLAN, decision,
+# egress ports). Nothing is formatted until the ring is dumped.
+class TraceRing:
+    record = struct.Struct('<dhQQHhBB')
+
+    def __init__(self, level=TRACE_LEVEL, sample=TRACE_SAMPLE, size=TRACE_RING_SIZE):
+        self.level = level
+        self.sample = sample
+        self.size = size
+        self.ring = bytearray(size * self.record.size)
+        # Records written so far; the next one goes to count % size
+        self.count = 0
+        # Records dumped so far
+        self.dumped = 0
+        # Frames to skip before the next sampled one
+        self.skip = 0
+        # Held for a record to be written, or the ring to be copied by dump
+        self.lock = threading.Lock()
+
+    def add(self, interface, dest_mac, src_mac, ethertype, vlan, decision, ports=0):
+        with self.lock:
+            offset = (self.count % self.size) * self.record.size
+            self.record.pack_into(self.ring, offset, time.time(), interface, dest_mac, src_mac,
+                                  ethertype, vlan, decision, ports)
+            self.count += 1
+
+    # True if the next frame is to be traced
+    def sampled(self):
+        if self.level < TRACE_FRAMES:
+            return False
+        if self.skip > 0:
+            self.skip -= 1
+            return False
+        self.skip = self.sample - 1
+        return True
+
+    # Prints the records not dumped yet, oldest first. The ring is copied
+    # under the lock, and formatted from the copy while the datapath goes on.
+    def dump(self, out=sys.stdout):
+        with self.lock:
+            ring = bytes(self.ring)
+            count = self.count
+        first = max(self.dumped, count - self.size)
+        for n in range(first, count):
+            t, interface, dest_mac, src_mac, ethertype, vlan, decision, ports = \
+                self.record.unpack_from(ring, (n % self.size) * self.record.size)
+            print('{:.6f} port {} {} -> {} type 0x{:04x} vlan {} {} {}'.format(
+                t, interface, src_mac.to_bytes(6, 'big').hex(':'),
+                dest_mac.to_bytes(6, 'big').hex(':'), ethertype, vlan,
+                TRACE_NAMES[decision], ports), file=out)
+        self.dumped = count
+        out.flush()
+
+# Dumps the trace on SIGUSR1, and before exiting on SIGTERM and SIGINT. The
+# signals are handled by a thread of their own, as the datapath may be
+# blocked in dlink.so; this must run before any other thread is started, so
+# that none of them gets the signals.
+def start_trace_dumper(trace):
+    signals = {signal.SIGUSR1, signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+
+    def dumper():
+        while True:
+            sig = signal.sigwait(signals)
+            trace.dump()
+            if sig != signal.SIGUSR1:
+                os._exit(0)
+
+    threading.Thread(target=dumper, daemon=True).start()
+    atexit.register(trace.dump)
+
+# Everything the datapath and the BPDU timer share. Both read and update the
+# same object, so the timer always sees the current STP state.
+class SwitchState:
+    def __init__(self, num_interfaces, priority, vlan_ids, port_options=()):
+        self.interfaces = range(0, num_interfaces)
+        self.vlan_ids = vlan_ids
+        self.lag = LinkAggregation(vlan_ids, port_options)
+        self.access_ports, self.trunk_ports = getPortLists(vlan_ids, self.lag.logical)
+        self.stp, self.own_bridge_id, self.root_bridge_id, self.root_path_cost = initSTP(vlan_ids, priority)
+        self.flows = MicroflowCache()
+        self.forwarding = ForwardingTable(self)
+        self.MAC_Table = MACTable(self.forget_mac)
+        self.switch_mac = get_switch_mac()
+        # Queue to the control plane, for workers only
+        self.control = None
+        # wrapper.FastPath, when frames are forwarded natively
+        self.fast_path = None
+        self.trace = TraceRing()
+        self.storm_control = StormControl([])
+        # IGMPSnooping, when multicast is only sent to the group members
+        self.igmp = None
+        self.arp = ARPCache() if ARP_SUPPRESSION != ARP_OFF else None
+        # Topology change: a TCN not acknowledged yet (non root), the end of
+        # the BPDU_TC announcement (root), a BPDU_TC announcement received
+        self.tcn_pending = False
+        self.tc_until = 0
+        self.tc_active = False
+
+    # Called when a MAC leaves the MAC table: its flows are flooded again
+    def forget_mac(self, key):
+        self.flows.invalidate()
+        if self.fast_path is not None:
+            self.fast_path.forget(key)
+
+# The workers' view of the shared MAC table. Lookups read the shared memory
+# and keep the known sources from aging out, new or moved MACs are sent to the
+# control plane, the only writer.
+class WorkerMACTable(wrapper.SharedMACTable):
+    def __init__(self, control):
+        self.control = control
+
+    def learn(self, mac, interface):
+        known = self.touch(mac)
+        if known != interface:
+            self.control.put((CTRL_LEARN, mac, interface))
+        return known
+
+# The MACs learnt on the trunks may now be behind another port. The port the
+# topology change came from is kept, as in RSTP; MACs on access ports never
+# move because of STP.
+def flush_trunks(sw, interface):
+    for i in sw.trunk_ports:
+        if i != interface:
+            sw.MAC_Table.flush(interface=i)
+
+# Makes every bridge hear of a topology change. The root sets BPDU_TC in its
+# BPDUs for TC_TIME seconds, starting now; the other bridges send a TCN on
+# their root port, repeated with the hello BPDUs until it is acknowledged.
+def notify_topology_change(sw, tx_frames):
+    stp = sw.stp
+    if sw.own_bridge_id == sw.root_bridge_id:
+        sw.tc_until = time.monotonic() + TC_TIME
+        bpdu = create_bpdu(sw.switch_mac, sw.own_bridge_id, 0, sw.own_bridge_id, BPDU_TC)
+        for i in sw.trunk_ports:
+            if stp[i] == 1: # Designated trunk
+                tx_frames.append((i, bpdu))
+    else:
+        sw.tcn_pending = True
+        tcn = create_tcn_bpdu(sw)
+        for i in sw.trunk_ports:
+            if stp[i] == 2: # Root port
+                tx_frames.append((i, tcn))
+
+# Learns the bindings of an ARP frame, and keeps a request for a known IP from
+# being flooded. Returns True if the frame was handled.
+def handle_arp(sw, interface, data, tagged, frame_vlan, tx_frames):
+    arp = 18 if tagged else 14
+    if len(data) < arp + ARP_PACKET.size:
+        return False
+    htype, ptype, hlen, plen, oper, sha, spa, tha, tpa = ARP_PACKET.unpack_from(data, arp)
+    if htype != 1 or ptype != 0x0800:
+        return False
+
+    # Requests and replies bind their sender; probes (sender IP 0.0.0.0)
+    # bind nothing
+    if oper not in (ARP_OP_REQUEST, ARP_OP_REPLY):
+        return False
+    if spa != bytes(4):
+        sw.arp.learn(frame_vlan, spa, sha)
+    # Replies and gratuitous ARPs (the sender asks for its own IP) go on
+    if oper == ARP_OP_REPLY or spa == tpa:
+        return False
+
+    mac = sw.arp.get(frame_vlan, tpa)
+    if mac is None:
+        return False
+
+    if ARP_SUPPRESSION == ARP_REPLY:
+        reply = sha + mac
+        if tagged:
+            reply += create_vlan_tag(frame_vlan)
+        reply += b'\x08\x06' + ARP_PACKET.pack(1, 0x0800, 6, 4, ARP_OP_REPLY, mac, tpa, sha, spa)
+        tx_frames.append((interface, reply))
+        return True
+
+    # The request goes on as unicast to the target, if it is known and
+    # reachable from here
+    dest_interface = sw.MAC_Table.get(fdb_key(frame_vlan, int.from_bytes(mac, byteorder='big')))
+    if dest_interface is None or dest_interface == interface:
+        return False
+    action = sw.forwarding.egress(interface, frame_vlan).get(dest_interface)
+    if action is None:
+        return False
+    (i, tag, start), = compile_actions([(dest_interface, action)], frame_vlan)
+    if i in sw.lag.active:
+        i = sw.lag.select(i, lag_hash(int.from_bytes(mac, byteorder='big'), int.from_bytes(data[6:12], byteorder='big'),
+                                      frame_vlan, 0x0806, data, arp, sw.lag.l3l4))
+    head = mac + data[6:12].tobytes()
+    if start == 0:
+        tx_frames.append((i, head, data[12:]))
+    else:
+        tx_frames.append((i, head + tag, data[start:]))
+    return True
+
+# Handles one received frame. The frames to send are appended to tx_frames.
+def process_frame(sw, interface, data, length, tx_frames):
+    vlan_ids = sw.vlan_ids
+    trunk_ports = sw.trunk_ports
+    stp = sw.stp
+    own_bridge_id = sw.own_bridge_id
+    MAC_Table = sw.MAC_Table
+
+    dest_mac, src_mac, ethertype, vlan_id = parse_ethernet_header(data)
+    # The members of a link aggregation group are one port
+    interface = sw.lag.logical[interface]
+
+    trace = sw.trace
+
+    # The VLAN of the frame: the port's on access ports, the tag's on trunks
+    frame_vlan = vlan_ids[interface] if vlan_ids[interface] != -1 else vlan_id
+    src_key = fdb_key(frame_vlan, src_mac)
+    dest_key = fdb_key(frame_vlan, dest_mac)
+
+    known_interface = MAC_Table.learn(src_key, interface)
+    if known_interface != interface:
+        # The flows to a MAC that moved go to its old port
+        if known_interface is not None:
+            sw.flows.invalidate()
+        if trace.level >= TRACE_CONTROL:
+            trace.add(interface, dest_mac, src_mac, ethertype, frame_vlan,
+                      TRACE_LEARN if known_interface is None else TRACE_MOVE)
+    if sw.fast_path is not None:
+        if frame_vlan != -1:
+            sw.fast_path.learn(src_key, interface)
+    # BDPU mac = 01:80:C2:00:00:00
+    if dest_mac == BPDU_MAC: # BPDU Package
+        if trace.level >= TRACE_CONTROL:
+            trace.add(interface, dest_mac, src_mac, ethertype, frame_vlan, TRACE_BPDU)
+        # Workers leave STP to the control plane
+        if sw.control is not None:
+            sw.control.put((CTRL_BPDU, interface, bytes(data)))
+            return
+
+        # BPDUs of 18 bytes have no type and flags
+        bpdu_type = data[18] if len(data) > 18 else BPDU_CONFIG
+        bpdu_flags = data[19] if len(data) > 19 else 0
+
+        # A bridge below saw its ports change: acknowledge it, and pass it
+        # on towards the root
+        if bpdu_type == BPDU_TCN:
+            tx_frames.append((interface, create_bpdu(sw.switch_mac, sw.root_bridge_id, sw.root_path_cost,
+                                                     own_bridge_id, BPDU_TCA)))
+            if own_bridge_id == sw.root_bridge_id:
+                flush_trunks(sw, interface)
+            notify_topology_change(sw, tx_frames)
+            return
+
+        if bpdu_flags & BPDU_TCA and stp[interface] == 2:
+            sw.tcn_pending = False
+        # The root announces a topology change: flush once, and pass the
+        # announcement down the tree
+        if bpdu_flags & BPDU_TC:
+            if not sw.tc_active:
+                sw.tc_active = True
+                flush_trunks(sw, interface)
+            bpdu = create_bpdu(sw.switch_mac, sw.root_bridge_id, sw.root_path_cost, own_bridge_id, BPDU_TC)
+            for i in trunk_ports:
+                if i != interface and stp[i] == 1: # Designated trunk
+                    tx_frames.append((i, bpdu))
+        elif stp[interface] == 2:
+            sw.tc_active = False
+
+        # Trunk port states before this BPDU
+        states = [stp[i] for i in trunk_ports]
+
+        bpdu_rb_id = int.from_bytes(data[12:14], byteorder='big')
+        # New Root Bridge
+        if bpdu_rb_id < sw.root_bridge_id:
+            sender_path_cost = int.from_bytes(data[14:16], byteorder='big')
+            sw.root_path_cost = 10 + sender_path_cost
+            stp[interface] = 2 # Root port
+    
+            # I was the Root Bridge
+            # if stp[len(interfaces)] == 1:
+            if own_bridge_id == sw.root_bridge_id:
+                sw.root_bridge_id = bpdu_rb_id
+                for i in trunk_ports:
+                    if stp[i] != 2: # Not Root Port and Trunk
+                        stp[i] = -1 # Blocked
+        
+            # Update the others
+            sender_bridge_id = own_bridge_id
+            sender_path_cost = sw.root_path_cost
+            bpdu = create_bpdu(sw.switch_mac, sw.root_bridge_id, sender_path_cost, sender_bridge_id)
+            for i in trunk_ports:
+                if stp[i] == 1: # Designated trunk
+                    tx_frames.append((i, bpdu))
+    
+        # It came from the root bridge
+        elif bpdu_rb_id == sw.root_bridge_id: 
+            bpdu_sender_cost = int.from_bytes(data[14:16], byteorder='big')
+            if stp[interface] == 2 and bpdu_sender_cost + 10 < sw.root_path_cost:
+                sw.root_path_cost = bpdu_sender_cost + 10
+            elif stp[interface] != 2:
+                if bpdu_sender_cost > sw.root_path_cost:
+                    stp[interface] = 1
+    
+        # It came from another bridge
+        elif int.from_bytes(data[12:14], byteorder='big') == own_bridge_id:
+            stp[interface] = -1
+    
+        else:
+            return
+    
+        if own_bridge_id == sw.root_bridge_id:
+            for i in sw.interfaces:
+                stp[i] = 1 # Designated
+
+        # The MACs learnt on the trunks that changed state are flushed right
+        # away, then the other bridges are told. Only the trunk states (the
+        # root port included) go into the forwarding table, which is rebuilt
+        # if one of them changed, not with every hello.
+        changed = [i for i, state in zip(trunk_ports, states) if stp[i] != state]
+        if changed:
+            for i in changed:
+                MAC_Table.flush(interface=i)
+            notify_topology_change(sw, tx_frames)
+            sw.forwarding.rebuild()
+
+    else:
+        if sw.arp is not None and ethertype == 0x0806:
+            if handle_arp(sw, interface, data, vlan_id != -1, frame_vlan, tx_frames):
+                return
+
+        # IGMP messages are read, then sent on by control_filter; they share
+        # their destination with the group's traffic, so their actions are
+        # never cached
+        igmp_type = None
+        if sw.igmp is not None and ethertype == 0x0800 and not isunicast(dest_mac):
+            igmp_type = IGMPSnooping.message_type(data, 14 if vlan_id == -1 else 18)
+            if igmp_type is not None and sw.igmp.snoop(data, 14 if vlan_id == -1 else 18, interface, frame_vlan):
+                sw.flows.invalidate()
+
+        flow = (interface, dest_key)
+        actions = sw.flows.get(flow) if igmp_type is None else None
+        # The flows to unknown unicast destinations are never cached
+        flooded = not isunicast(dest_mac) or (actions is None and dest_key not in MAC_Table)
+        # The excess is dropped before the frame is copied to every port
+        if flooded and not sw.storm_control.admit(interface, dest_mac, length):
+            if trace.sampled():
+                trace.add(interface, dest_mac, src_mac, ethertype, frame_vlan, TRACE_STORM)
+            return
+
+        if actions is None:
+            if isunicast(dest_mac) and dest_key in MAC_Table: # knows where to go
+                dest_interface = MAC_Table[dest_key]
+                action = sw.forwarding.egress(interface, frame_vlan).get(dest_interface)
+                egress = [] if action is None else [(dest_interface, action)]
+                actions = compile_actions(egress, frame_vlan)
+                sw.flows.put(flow, actions)
+            else: # unknown unicast (ARP) and multicast are flooded
+                egress = sw.forwarding.flood(interface, frame_vlan)
+                if igmp_type is not None:
+                    egress = sw.igmp.control_filter(frame_vlan, igmp_type, egress, trunk_ports)
+                elif sw.igmp is not None and not isunicast(dest_mac):
+                    egress = sw.igmp.filter(frame_vlan, dest_mac, egress)
+                actions = compile_actions(egress, frame_vlan)
+                if not isunicast(dest_mac) and igmp_type is None:
+                    sw.flows.put(flow, actions)
+
+        lags = sw.lag.active
+        h = None
+        for i, tag, start in actions:
+            if i in lags:
+                if h is None:
+                    h = lag_hash(dest_mac, src_mac, frame_vlan, ethertype, data, 14 if vlan_id == -1 else 18,
+                                 sw.lag.l3l4)
+                i = sw.lag.select(i, h)
+            if start == 0:
+                tx_frames.append((i, data))
+            else:
+                tx_frames.append((i, data[0:12].tobytes() + tag, data[start:]))
+
+        if trace.sampled():
+            if not actions:
+                decision = TRACE_DROP
+            elif isunicast(dest_mac) and dest_key in MAC_Table:
+                decision = TRACE_FORWARD
+            else:
+                decision = TRACE_FLOOD
+            trace.add(interface, dest_mac, src_mac, ethertype, frame_vlan, decision, len(actions))
+
+# Receives and forwards frames from any interface, one batch at a time
+def run_datapath(sw, pool):
+    while True:
+        # Process a whole batch of frames per iteration.
+        # Note that data is a read-only memoryview into the frame pool. It
+        # can be sliced and sent as is, or as a (head, tail) pair.
+        # Frames to send are collected for the whole batch and sent at once
+        tx_frames = []
+        frames = pool.recv(BATCH_SIZE)
+        # In the workers, the STP states are changed by the control plane
+        # The workers have no BPDU timer to check the LAG member links
+        if sw.control is not None:
+            sw.forwarding.sync()
+            sw.flows.sync(sw.MAC_Table.generation)
+            sw.lag.poll(time.monotonic())
+        else:
+            now = time.monotonic()
+            sw.MAC_Table.tick(now)
+            if sw.igmp is not None and sw.igmp.tick(now):
+                sw.flows.invalidate()
+        for interface, data, length in frames:
+            process_frame(sw, interface, data, length, tx_frames)
+
+        sw.lag.redirect(tx_frames)
+        send_batch(tx_frames)
+        # The frames were sent, their buffers can be reused
+        pool.release_batch(frames)
+
+# Called by the event loop when an interface has frames queued. Handles at
+# most one batch, so the other ports and the BPDU timer get their turn; the
+# loop calls again while frames are left.
+def on_interface_readable(sw, pool, interface):
+    frames = pool.recv_from(interface, BATCH_SIZE)
+    now = time.monotonic()
+    sw.MAC_Table.tick(now)
+    if sw.igmp is not None and sw.igmp.tick(now):
+        sw.flows.invalidate()
+    tx_frames = []
+    for _, data, length in frames:
+        process_frame(sw, interface, data, length, tx_frames)
+
+    sw.lag.redirect(tx_frames)
+    send_batch(tx_frames)
+    pool.release_batch(frames)
+
+async def send_bdpu_every_sec_async(sw):
+    while True:
+        send_hello_bpdus(sw)
+        sw.lag.poll(time.monotonic())
+        await asyncio.sleep(1)
+
+# Every port and the BPDU timer run on a single asyncio loop, in one thread
+async def run_datapath_async(sw, pool):
+    loop = asyncio.get_running_loop()
+    for i in sw.interfaces:
+        loop.add_reader(wrapper.get_interface_fd(i), on_interface_readable, sw, pool, i)
+
+    await send_bdpu_every_sec_async(sw)
+
+# Received frames are read-only memoryviews into this pool (or into the
+# kernel's receive rings)
+def create_pool(num_interfaces):
+    if RX_BACKEND == wrapper.RX_BACKEND_RING:
+        return RxRing(num_interfaces)
+    return FramePool()
+
+# A forwarding process. It opens its own sockets and joins them to the fanout
+# groups, so it gets its share of the frames of every port.
+def run_worker(switch_id, interface_names, fanout_group, control):
+    # Don't outlive the control plane, even if it is killed (SIGTERM dumps
+    # the trace, then exits)
+    PR_SET_PDEATHSIG = 1
+    ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    trace = TraceRing()
+    start_trace_dumper(trace)
+
+    priority, vlan_ids, port_options = readCfgFile(switch_id)
+
+    num_interfaces = wrapper.init(interface_names, RX_BACKEND, TX_BACKEND, EGRESS_QUEUE_LEN, EGRESS_DROP,
+                                  SWITCHED_ETHERTYPES, mtus=port_mtus(port_options))
+    wrapper.join_fanout(fanout_group)
+
+    sw = SwitchState(num_interfaces, priority, vlan_ids, port_options)
+    sw.trace = trace
+    sw.storm_control = StormControl(port_options, NUM_WORKERS)
+    sw.MAC_Table = WorkerMACTable(control)
+    sw.stp = wrapper.SharedSTPStates()
+    sw.control = control
+
+    run_datapath(sw, create_pool(num_interfaces))
+
+# The control plane learns the MACs reported by the workers and runs STP. It
+# only sends: the hello BPDUs and the BPDUs triggered by the received ones.
+def run_control_plane(sw, control):
+    next_expire = 0
+    while True:
+        # The control plane, the only writer, ages the shared MAC table
+        now = time.monotonic()
+        if now >= next_expire:
+            sw.MAC_Table.expire(MAC_AGING_TIME)
+            next_expire = now + MAC_REFRESH
+        try:
+            kind, a, b = control.get(timeout=MAC_REFRESH)
+        except queue.Empty:
+            continue
+        if kind == CTRL_LEARN:
+            sw.MAC_Table[a] = b
+        else:
+            tx_frames = []
+            process_frame(sw, a, b, len(b), tx_frames)
+            sw.lag.redirect(tx_frames)
+            send_batch(tx_frames)
+
+def run_multi_process(switch_id, interface_names, trace):
+    priority, vlan_ids, port_options = readCfgFile(switch_id)
+
+    # The shared state must exist before the workers are forked
+    wrapper.create_shared_state(len(interface_names))
+    stp = wrapper.SharedSTPStates(initSTP(vlan_ids, priority)[0])
+
+    ctx = multiprocessing.get_context('fork')
+    control = ctx.Queue()
+    fanout_group = os.getpid() & 0xffff
+    for _ in range(NUM_WORKERS):
+        ctx.Process(target=run_worker, args=(switch_id, interface_names, fanout_group, control),
+                    daemon=True).start()
+
+    num_interfaces = wrapper.init(interface_names, wrapper.RX_BACKEND_SOCKET, TX_BACKEND,
+                                  EGRESS_QUEUE_LEN, EGRESS_DROP, mtus=port_mtus(port_options))
+    wrapper.disable_rx()
+
+    sw = SwitchState(num_interfaces, priority, vlan_ids, port_options)
+    sw.trace = trace
+    sw.MAC_Table = wrapper.SharedMACTable()
+    sw.stp = stp
+
+    # Printing interface names
+    for i in sw.interfaces:
+        print(get_interface_name(i))
+
+    t = threading.Thread(target=send_bdpu_every_sec, args=(sw,))
+    t.start()
+
+    run_control_plane(sw, control)
+
 def main():
     # init returns the max interface number. Our interfaces
     # are 0, 1, 2, ..., init_ret value + 1
     switch_id = sys.argv[1]
 
-    num_interfaces = wrapper.init(sys.argv[2:])
-    interfaces = range(0, num_interfaces)
+    trace = TraceRing()
+    start_trace_dumper(trace)
 
-    priority, vlan_ids = readCfgFile(switch_id)
+    if NUM_WORKERS > 1:
+        run_multi_process(switch_id, sys.argv[2:], trace)
+        return
 
-    stp, own_bridge_id, root_bridge_id, root_path_cost = initSTP(vlan_ids, priority)
-    # Create and start a new thread that deals with sending BDPU
-    t = threading.Thread(target=send_bdpu_every_sec, args=(stp, own_bridge_id, root_bridge_id, vlan_ids, priority, interfaces))
-    t.start()
+    priority, vlan_ids, port_options = readCfgFile(switch_id)
+
+    num_interfaces = wrapper.init(sys.argv[2:], RX_BACKEND, TX_BACKEND, EGRESS_QUEUE_LEN, EGRESS_DROP,
+                                  SWITCHED_ETHERTYPES, mtus=port_mtus(port_options))
 
-    MAC_Table = {}
+    sw = SwitchState(num_interfaces, priority, vlan_ids, port_options)
+    sw.trace = trace
+    sw.storm_control = StormControl(port_options)
+    if IGMP_SNOOPING:
+        sw.igmp = IGMPSnooping(port_options)
+    if FAST_PATH:
+        sw.fast_path = wrapper.FastPath(vlan_ids)
+        sw.stp = wrapper.FastPathSTPStates(sw.stp)
+        sw.lag.set_fast_path(sw.fast_path)
+        sw.MAC_Table.hits = sw.fast_path.hits
+
+    pool = create_pool(num_interfaces)
 
     # Printing interface names
-    for i in interfaces:
+    for i in sw.interfaces:
         print(get_interface_name(i))
 
-    while True:
-        # Note that data is of type bytes([...]).
-        # b1 = bytes([72, 101, 108, 108, 111])  # "Hello"
-        # b2 = bytes([32, 87, 111, 114, 108, 100])  # " World"
-        # b3 = b1[0:2] + b[3:4].
-        interface, data, length = recv_from_any_link()
-
-        dest_mac, src_mac, ethertype, vlan_id = parse_ethernet_header(data)
-
-        dest_mac_int = dest_mac
-        src_mac_int = src_mac
-
-        # Print the MAC src and MAC dst in human readable format
-        dest_mac = ':'.join(f'{b:02x}' for b in dest_mac)
-        src_mac = ':'.join(f'{b:02x}' for b in src_mac)
-
-        # Note. Adding a VLAN tag can be as easy as
-        # tagged_frame = data[0:12] + create_vlan_tag(10) + data[12:]
-
-        print(f'Destination MAC: {dest_mac}')
-        print(f'Source MAC: {src_mac}')
-        print(f'EtherType: {ethertype}')
-
-        print("Received frame of size {} on interface {}".format(length, interface), flush=True)
-
-        # TODO: Implement forwarding with learning
-        MAC_Table[src_mac_int] = interface
-        # BDPU mac = 01:80:C2:00:00:00
-        if dest_mac_int == bytes([0x01, 0x80, 0xc2, 0x00, 0x00, 0x00]): # BPDU Package
-            bpdu_rb_id = int.from_bytes(data[12:14], byteorder='big')
-            # New Root Bridge
-            if bpdu_rb_id < root_bridge_id:
-                sender_path_cost = int.from_bytes(data[14:16], byteorder='big')
-                root_path_cost = 10 + sender_path_cost
-                stp[interface] = 2 # Root port
-            
-                # I was the Root Bridge
-                # if stp[len(interfaces)] == 1:
-                if own_bridge_id == root_bridge_id:
-                    root_bridge_id = bpdu_rb_id
-                    for i in interfaces:
-                        if stp[i] != 2 and vlan_ids[i] == -1: # Not Root Port and Trunk
-                            stp[i] = -1 # Blocked
-                
-                # Update the others
-                sender_bridge_id = own_bridge_id
-                sender_path_cost = root_path_cost
-                bpdu = create_bpdu(get_switch_mac(), root_bridge_id, sender_path_cost, sender_bridge_id)
-                for i in interfaces:
-                    if stp[i] == 1 and vlan_ids[i] == -1: # Designated trunk
-                        send_to_link(i, bpdu, 18)
-            
-            # It came from the root bridge
-            elif bpdu_rb_id == root_bridge_id: 
-                bpdu_sender_cost = int.from_bytes(data[14:16], byteorder='big')
-                if stp[interface] == 2 and bpdu_sender_cost + 10 < root_path_cost:
-                    root_path_cost = bpdu_sender_cost + 10
-                elif stp[interface] != 2:
-                    if bpdu_sender_cost > root_path_cost:
-                        stp[interface] = 1
-            
-            # It came from another bridge
-            elif int.from_bytes(data[12:14], byteorder='big') == own_bridge_id:
-                stp[interface] = -1
-            
-            else:
-                continue
-            
-            if own_bridge_id == root_bridge_id:
-                for i in interfaces:
-                    stp[i] = 1 # Designated
+    if ASYNCIO_DATAPATH:
+        asyncio.run(run_datapath_async(sw, pool))
+    else:
+        # Create and start a new thread that deals with sending BDPU
+        t = threading.Thread(target=send_bdpu_every_sec, args=(sw,))
+        t.start()
 
-        else:
-            if isunicast(dest_mac_int): # unicast
-                if dest_mac_int in MAC_Table: # knows where to go
-                    if vlan_ids[interface] != -1: # Host
-                        if vlan_ids[MAC_Table[dest_mac_int]] != -1: # Host->Host
-                            if vlan_ids[MAC_Table[dest_mac_int]] == vlan_ids[interface]:
-                                send_to_link(MAC_Table[dest_mac_int], data, length)
-                        else: # Host->Switch
-                            tagged_data = data[0:12] + create_vlan_tag(vlan_ids[interface]) + data[12:]
-                            send_to_link(MAC_Table[dest_mac_int], tagged_data, length+4)
-                    else: # Switch
-                        if vlan_ids[MAC_Table[dest_mac_int]] == -1: # Switch->Switch
-                            if stp[MAC_Table[dest_mac_int]] != -1:
-                                send_to_link(MAC_Table[dest_mac_int], data, length)
-                        else: # Switch->Host
-                            if vlan_ids[MAC_Table[dest_mac_int]] == vlan_id:
-                                untagged_data = data[0:12] + data[16:]
-                                send_to_link(MAC_Table[dest_mac_int], untagged_data, length-4)
-                else: # ARP
-                    for i in interfaces:
-                        if i != interface:
-                            if vlan_ids[interface] != -1: # Host
-                                if vlan_ids[i] != -1: # Host->Host
-                                    if vlan_ids[i] == vlan_ids[interface]:
-                                        send_to_link(i, data, length)
-                                else: # Host->Switch
-                                    tagged_data = data[0:12] + create_vlan_tag(vlan_ids[interface]) + data[12:]
-                                    send_to_link(i, tagged_data, length+4)
-                            else: # Switch
-                                if vlan_ids[i] == -1: # Switch->Switch
-                                    if stp[i] != -1:
-                                        send_to_link(i, data, length)
-                                else: # Switch->Host
-                                    if vlan_ids[i] == vlan_id:
-                                        untagged_data = data[0:12] + data[16:]
-                                        send_to_link(i, untagged_data, length-4)
-            else: # multicast
-                for i in interfaces:
-                    if i != interface:
-                        if vlan_ids[interface] != -1: # Host
-                            if vlan_ids[i] != -1: # Host->Host
-                                if vlan_ids[i] == vlan_ids[interface]:
-                                    send_to_link(i, data, length)
-                            else: # Host->Switch
-                                tagged_data = data[0:12] + create_vlan_tag(vlan_ids[interface]) + data[12:]
-                                send_to_link(i, tagged_data, length+4)
-                        else: # Switch
-                            if vlan_ids[i] == -1: # Switch->Switch
-                                if stp[i] != -1:
-                                    send_to_link(i, data, length)
-                            else: # Switch->Host
-                                if vlan_ids[i] == vlan_id:
-                                    untagged_data = data[0:12] + data[16:]
-                                    send_to_link(i, untagged_data, length-4)
-        # data is of type bytes.
-        #send_to_link(i, data, length)
+        run_datapath(sw, pool)
 
 if __name__ == "__main__":
     main()
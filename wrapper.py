@@ -2,6 +2,24 @@ import ctypes
 import sys
 from ctypes import create_string_buffer
 
+# The frame buffers are sized from the MTUs (get_max_frame_len); this is the
+# smallest size
+MAX_PACKET_LEN = 1600
+MAX_BATCH_LEN = 64
+# Entries of the fast path's FDB mirror (FASTPATH_FDB_SIZE)
+FASTPATH_FDB_SIZE = 4096
+FRAME_POOL_SIZE = 256
+
+# Receive and transmit backends, see init()
+RX_BACKEND_SOCKET = 0
+RX_BACKEND_RING = 1
+TX_BACKEND_SOCKET = 0
+TX_BACKEND_RING = 2
+
+# What to drop when a frame is sent to a full egress queue, see init()
+EGRESS_DROP_TAIL = 0
+EGRESS_DROP_HEAD = 1
+
 # Load the shared library with the data link functions
 lib = ctypes.CDLL('./dlink.so')
 
@@ -9,33 +27,386 @@ lib = ctypes.CDLL('./dlink.so')
 lib.recv_from_any_link.argtypes = (ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t))
 lib.recv_from_any_link.restype = ctypes.c_int
 
-lib.send_to_link.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t)
+lib.recv_batch.argtypes = (ctypes.POINTER(ctypes.c_void_p), ctypes.c_size_t, ctypes.POINTER(ctypes.c_int),
+                           ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.recv_batch.restype = ctypes.c_int
+
+lib.recv_batch_from_link.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_void_p), ctypes.c_size_t,
+                                     ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.recv_batch_from_link.restype = ctypes.c_int
+
+lib.get_interface_fd.argtypes = [ctypes.c_int]
+lib.get_interface_fd.restype = ctypes.c_int
+
+lib.send_to_link.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
 lib.send_to_link.restype = ctypes.c_int
 
+lib.send_to_link_iov.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_void_p, ctypes.c_size_t)
+lib.send_to_link_iov.restype = ctypes.c_int
+
+lib.send_batch.argtypes = (ctypes.POINTER(ctypes.c_int),
+                           ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_size_t),
+                           ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_size_t),
+                           ctypes.c_int)
+lib.send_batch.restype = ctypes.c_int
+
 lib.init.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p))
 lib.init.restype = ctypes.c_int
 
+lib.init_backend.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p), ctypes.c_int)
+lib.init_backend.restype = ctypes.c_int
+
+lib.ring_recv_batch.argtypes = (ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),
+                                ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.ring_recv_batch.restype = ctypes.c_int
+
+lib.ring_recv_from_link.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_void_p),
+                                    ctypes.POINTER(ctypes.c_size_t), ctypes.c_int)
+lib.ring_recv_from_link.restype = ctypes.c_int
+
+lib.ring_release.argtypes = ()
+lib.ring_release.restype = None
+
+lib.get_rx_ring.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_size_t))
+lib.get_rx_ring.restype = ctypes.c_int
+
 lib.get_interface_mac.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_uint8))
 lib.get_interface_mac.restype = None
 
 lib.get_interface_name.argtypes = [ctypes.c_int]
 lib.get_interface_name.restype = ctypes.c_char_p
 
-def init(argv_p):
+lib.get_link_up.argtypes = [ctypes.c_int]
+lib.get_link_up.restype = ctypes.c_int
+
+lib.set_interface_mtu.argtypes = (ctypes.c_char_p, ctypes.c_int)
+lib.set_interface_mtu.restype = ctypes.c_int
+
+lib.get_interface_mtu.argtypes = [ctypes.c_int]
+lib.get_interface_mtu.restype = ctypes.c_int
+
+lib.get_max_frame_len.argtypes = ()
+lib.get_max_frame_len.restype = ctypes.c_size_t
+
+# Frames of an interface dropped for their size, and its receive errors
+# (struct link_stats)
+class LinkStats(ctypes.Structure):
+    _fields_ = [("rx_oversize", ctypes.c_uint64),
+                ("tx_oversize", ctypes.c_uint64),
+                ("rx_errors", ctypes.c_uint64)]
+
+lib.get_link_stats.argtypes = (ctypes.c_int, ctypes.POINTER(LinkStats))
+lib.get_link_stats.restype = ctypes.c_int
+
+# Counters of the egress queue of an interface (struct egress_stats)
+class EgressStats(ctypes.Structure):
+    _fields_ = [("enqueued", ctypes.c_uint64),
+                ("sent", ctypes.c_uint64),
+                ("dropped", ctypes.c_uint64),
+                ("errors", ctypes.c_uint64),
+                ("depth", ctypes.c_uint32),
+                ("max_depth", ctypes.c_uint32)]
+
+lib.egress_queues_start.argtypes = (ctypes.c_uint, ctypes.c_int)
+lib.egress_queues_start.restype = ctypes.c_int
+
+lib.get_egress_stats.argtypes = (ctypes.c_int, ctypes.POINTER(EgressStats))
+lib.get_egress_stats.restype = ctypes.c_int
+
+lib.set_rx_filter.argtypes = (ctypes.POINTER(ctypes.c_uint16), ctypes.c_int, ctypes.c_int)
+lib.set_rx_filter.restype = ctypes.c_int
+
+class FastPathStats(ctypes.Structure):
+    _fields_ = [("forwarded", ctypes.c_uint64),
+                ("dropped", ctypes.c_uint64),
+                ("punted", ctypes.c_uint64)]
+
+lib.fastpath_enable.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+lib.fastpath_enable.restype = ctypes.c_int
+
+lib.fastpath_fdb_set.argtypes = (ctypes.c_char_p, ctypes.c_int, ctypes.c_int)
+lib.fastpath_fdb_set.restype = ctypes.c_int
+
+lib.fastpath_fdb_remove.argtypes = (ctypes.c_char_p, ctypes.c_int)
+lib.fastpath_fdb_remove.restype = None
+
+lib.fastpath_fdb_hits.argtypes = (ctypes.POINTER(ctypes.c_uint64), ctypes.c_int)
+lib.fastpath_fdb_hits.restype = ctypes.c_int
+
+lib.fastpath_set_lag.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_int)
+lib.fastpath_set_lag.restype = ctypes.c_int
+
+lib.fastpath_set_port_state.argtypes = (ctypes.c_int, ctypes.c_int)
+lib.fastpath_set_port_state.restype = None
+
+lib.fastpath_get_stats.argtypes = [ctypes.POINTER(FastPathStats)]
+lib.fastpath_get_stats.restype = None
+
+lib.join_fanout.argtypes = [ctypes.c_int]
+lib.join_fanout.restype = ctypes.c_int
+
+lib.disable_rx.argtypes = ()
+lib.disable_rx.restype = ctypes.c_int
+
+lib.shared_state_create.argtypes = [ctypes.c_int]
+lib.shared_state_create.restype = ctypes.c_int
+
+lib.fdb_lookup.argtypes = [ctypes.c_uint64]
+lib.fdb_lookup.restype = ctypes.c_int
+
+lib.fdb_touch.argtypes = [ctypes.c_uint64]
+lib.fdb_touch.restype = ctypes.c_int
+
+lib.fdb_learn.argtypes = (ctypes.c_uint64, ctypes.c_int)
+lib.fdb_learn.restype = ctypes.c_int
+
+lib.fdb_expire.argtypes = [ctypes.c_uint]
+lib.fdb_expire.restype = ctypes.c_int
+
+lib.fdb_flush.argtypes = (ctypes.c_int, ctypes.c_int)
+lib.fdb_flush.restype = ctypes.c_int
+
+lib.fdb_generation.argtypes = ()
+lib.fdb_generation.restype = ctypes.c_uint
+
+lib.stp_get_state.argtypes = [ctypes.c_int]
+lib.stp_get_state.restype = ctypes.c_int
+
+lib.stp_set_state.argtypes = (ctypes.c_int, ctypes.c_int)
+lib.stp_set_state.restype = None
+
+lib.stp_generation.argtypes = ()
+lib.stp_generation.restype = ctypes.c_uint
+
+# Py_buffer, used to get the address of any object supporting the buffer
+# protocol (bytes, bytearray, memoryview) without copying it
+class Py_buffer(ctypes.Structure):
+    _fields_ = [("buf", ctypes.c_void_p),
+                ("obj", ctypes.c_void_p),
+                ("len", ctypes.c_ssize_t),
+                ("itemsize", ctypes.c_ssize_t),
+                ("readonly", ctypes.c_int),
+                ("ndim", ctypes.c_int),
+                ("format", ctypes.c_char_p),
+                ("shape", ctypes.POINTER(ctypes.c_ssize_t)),
+                ("strides", ctypes.POINTER(ctypes.c_ssize_t)),
+                ("suboffsets", ctypes.POINTER(ctypes.c_ssize_t)),
+                ("internal", ctypes.c_void_p)]
+
+ctypes.pythonapi.PyObject_GetBuffer.argtypes = (ctypes.py_object, ctypes.POINTER(Py_buffer), ctypes.c_int)
+ctypes.pythonapi.PyObject_GetBuffer.restype = ctypes.c_int
+
+ctypes.pythonapi.PyBuffer_Release.argtypes = (ctypes.POINTER(Py_buffer),)
+ctypes.pythonapi.PyBuffer_Release.restype = None
+
+ctypes.pythonapi.PyMemoryView_FromMemory.argtypes = (ctypes.c_void_p, ctypes.c_ssize_t, ctypes.c_int)
+ctypes.pythonapi.PyMemoryView_FromMemory.restype = ctypes.py_object
+PyBUF_READ = 0x100
+
+# Pins a contiguous buffer and returns its Py_buffer. The memory stays valid
+# until the Py_buffer is given to release_frame_buffer. Raises if frame has no
+# contiguous buffer.
+def get_frame_buffer(frame):
+    view = Py_buffer()
+    if ctypes.pythonapi.PyObject_GetBuffer(frame, ctypes.byref(view), 0) != 0: # PyBUF_SIMPLE
+        raise BufferError("no contiguous buffer in {}".format(type(frame).__name__))
+    return view
+
+def release_frame_buffer(view):
+    ctypes.pythonapi.PyBuffer_Release(ctypes.byref(view))
+
+# The receive backend is chosen here: RX_BACKEND_SOCKET reads the frames from
+# the packet sockets (recv_batch, FramePool), RX_BACKEND_RING maps a TPACKET_V3
+# ring per interface (RxRing). With TX_BACKEND_RING, all the send functions
+# copy the frames in a PACKET_TX_RING per interface and flush it with a single
+# send(); a full ring is reported back instead of blocking.
+# With egress_queue_len > 0, every interface gets a queue of that many frames
+# and its own transmit thread (running without the GIL): the send functions
+# only copy the frames in the queues. egress_drop tells which frame is dropped
+# when a queue is full.
+# Received frames are filtered in the kernel: with ethertypes, only the BPDUs
+# and the frames of these ethertypes (tagged or not) are received, and with
+# ignore_outgoing the frames sent on an interface are not received back.
+# mtus sets the MTU of the interfaces (None keeps the kernel's); the buffers
+# are then sized for the largest one.
+def init(argv_p, rx_backend=RX_BACKEND_SOCKET, tx_backend=TX_BACKEND_SOCKET,
+         egress_queue_len=0, egress_drop=EGRESS_DROP_TAIL, ethertypes=(),
+         ignore_outgoing=True, mtus=()):
     # Get the command-line arguments using sys.argv
     print("Initializing the switch")
     argv = [arg.encode('utf-8') for arg in argv_p]  # Convert each argument to bytes
 
+    for name, mtu in zip(argv, mtus):
+        if mtu is not None:
+            ret = lib.set_interface_mtu(name, mtu)
+            assert ret == 0, "set_interface_mtu {}: {}".format(name.decode(), ret)
+
     # Convert the list to a ctypes array
     argc = len(argv)
     argv_array = (ctypes.c_char_p * argc)(*argv)
     # Call the hub init function
-    num_int = lib.init(argc, argv_array)
+    num_int = lib.init_backend(argc, argv_array, rx_backend | tx_backend)
+    c_ethertypes = (ctypes.c_uint16 * len(ethertypes))(*ethertypes)
+    ret = lib.set_rx_filter(c_ethertypes, len(ethertypes), int(ignore_outgoing))
+    assert ret == 0, "set_rx_filter: {}".format(ret)
+    if egress_queue_len > 0:
+        ret = lib.egress_queues_start(egress_queue_len, egress_drop)
+        assert ret == 0, "egress_queues_start: {}".format(ret)
     return num_int
 
+# Spreads the frames of every interface over all the processes that join the
+# same group (PACKET_FANOUT, hash mode: a flow always goes to one process).
+# Frames sent by the other members are not received.
+def join_fanout(group_id):
+    ret = lib.join_fanout(group_id)
+    assert ret == 0, "join_fanout: {}".format(ret)
+
+# For a process that only sends: every frame received is dropped by the kernel
+def disable_rx():
+    ret = lib.disable_rx()
+    assert ret == 0, "disable_rx: {}".format(ret)
+
+# Creates the MAC table and STP port states shared by every process forked
+# afterwards. They are read without locks and must be written by one process
+# only.
+def create_shared_state(num_interfaces):
+    ret = lib.shared_state_create(num_interfaces)
+    assert ret == 0, "shared_state_create: {}".format(ret)
+
+# The shared MAC table, used like a dict of key -> interface. A key is
+# VLAN << 48 | MAC, the MAC as an integer. Entries age out when not seen
+# (touched or learnt) for a while, and when the table is full the least
+# recently seen one makes room.
+class SharedMACTable:
+    def __contains__(self, key):
+        return lib.fdb_lookup(key) != -1
+
+    def __getitem__(self, key):
+        interface = lib.fdb_lookup(key)
+        if interface == -1:
+            raise KeyError(key)
+        return interface
+
+    def get(self, key, default=None):
+        interface = lib.fdb_lookup(key)
+        return default if interface == -1 else interface
+
+    def __setitem__(self, key, interface):
+        ret = lib.fdb_learn(key, interface)
+        assert ret >= 0, "fdb_learn: {}".format(ret)
+
+    # Looks up a source MAC and marks it as seen now; returns its interface,
+    # or None
+    def touch(self, key):
+        interface = lib.fdb_touch(key)
+        return None if interface == -1 else interface
+
+    # Learns a source MAC; returns the port it was on before, or None
+    def learn(self, key, interface):
+        known = self.touch(key)
+        if known != interface:
+            self[key] = interface
+        return known
+
+    # Removes the entries not seen for aging_time seconds; returns how many
+    def expire(self, aging_time):
+        return lib.fdb_expire(aging_time)
+
+    # Removes the entries of a VLAN, of a port, or both
+    def flush(self, vlan=None, interface=None):
+        lib.fdb_flush(-1 if vlan is None else vlan & 0x0FFF, -1 if interface is None else interface)
+
+    # Changes every time a MAC moves to another port or is flushed, in any
+    # process
+    @property
+    def generation(self):
+        return lib.fdb_generation()
+
+# The shared STP port states, used like the list returned by initSTP
+class SharedSTPStates:
+    def __init__(self, states=None):
+        if states is not None:
+            for i, state in enumerate(states):
+                self[i] = state
+
+    def __getitem__(self, interface):
+        return lib.stp_get_state(interface)
+
+    def __setitem__(self, interface, state):
+        lib.stp_set_state(interface, state)
+
+    # Changes with every state change, made by any process
+    @property
+    def generation(self):
+        return lib.stp_generation()
+
+# Native forwarding of known unicast frames, inside the receive functions.
+# Python stays the control plane: it pushes down what it learns (learn) and
+# the STP port states (through stp_states), and only gets the frames the fast
+# path can't handle: BPDUs, multicast and broadcast, unknown destinations, and
+# new or moved sources. vlan_ids is the VLAN of every port, -1 for trunks.
+class FastPath:
+    def __init__(self, vlan_ids):
+        c_vlans = (ctypes.c_int * len(vlan_ids))(*vlan_ids)
+        ret = lib.fastpath_enable(c_vlans, len(vlan_ids))
+        assert ret == 0, "fastpath_enable: {}".format(ret)
+        # MAC table key (VLAN << 48 | MAC) -> interface, as pushed down
+        self.macs = {}
+        self.hit_keys = (ctypes.c_uint64 * FASTPATH_FDB_SIZE)()
+
+    # Called for every source MAC Python learns. When the mirror is full,
+    # the MAC is pushed again with its next frame
+    def learn(self, key, interface):
+        if self.macs.get(key) != interface:
+            if lib.fastpath_fdb_set((key & 0xFFFFFFFFFFFF).to_bytes(6, 'big'), key >> 48, interface) == 0:
+                self.macs[key] = interface
+
+    # Called for every MAC Python forgets (aged out or evicted)
+    def forget(self, key):
+        if self.macs.pop(key, None) is not None:
+            lib.fastpath_fdb_remove((key & 0xFFFFFFFFFFFF).to_bytes(6, 'big'), key >> 48)
+
+    # Returns the keys of the MACs the fast path forwarded frames from since
+    # the last call. Python doesn't see these frames, and must refresh the
+    # MACs so that they don't age out.
+    def hits(self):
+        n = lib.fastpath_fdb_hits(self.hit_keys, FASTPATH_FDB_SIZE)
+        return self.hit_keys[:n]
+
+    # Spreads the frames sent to a logical port over the active members of
+    # its link aggregation group
+    def set_lag(self, interface, members, l3l4):
+        c_members = (ctypes.c_int * len(members))(*members)
+        ret = lib.fastpath_set_lag(interface, c_members, len(members), l3l4)
+        assert ret == 0, "fastpath_set_lag: {}".format(ret)
+
+    def stats(self):
+        stats = FastPathStats()
+        lib.fastpath_get_stats(ctypes.byref(stats))
+        return {name: getattr(stats, name) for name, _ in FastPathStats._fields_}
+
+# STP port states kept in a list and pushed down to the fast path, used like
+# the list returned by initSTP
+class FastPathSTPStates:
+    def __init__(self, states):
+        self.states = list(states)
+        for i, state in enumerate(self.states):
+            lib.fastpath_set_port_state(i, state)
+
+    def __getitem__(self, interface):
+        return self.states[interface]
+
+    def __setitem__(self, interface, state):
+        self.states[interface] = state
+        lib.fastpath_set_port_state(interface, state)
+
+    def __len__(self):
+        return len(self.states)
+
 def recv_from_any_link():
     # Create a buffer for the data to be written into
-    buffer_size = 1600 # MAX_PACKET_LEN
+    buffer_size = get_max_frame_len()
 
     buffer = ctypes.create_string_buffer(buffer_size)
     # Create a ctypes variable for the length
@@ -46,18 +417,218 @@ def recv_from_any_link():
 
     return result, bytes(buffer.raw[:length.value]), length.value
 
-# Receives an interface, a byte array and a length.
-def send_to_link(interface, buffer, length):
-    # Create a buffer for the data to be written into
-    buffer_size = length
-    # Make sure buffer is smaller than MAX_PACKET_LEN
-    assert(buffer_size < 1600)
-    
-    c_buf = create_string_buffer(buffer)
-    c_len = ctypes.c_size_t(buffer_size)
+# Batch buffers are allocated by the first recv_batch call, once the MTUs are
+# known, and reused by the next ones
+_batch_frames = None
+_batch_ptrs = (ctypes.c_void_p * MAX_BATCH_LEN)()
+_batch_ifaces = (ctypes.c_int * MAX_BATCH_LEN)()
+_batch_lengths = (ctypes.c_size_t * MAX_BATCH_LEN)()
 
-    # Call the C function
-    result = lib.send_to_link(interface, c_buf, c_len)
+# Blocks until at least one frame is available and returns up to max_frames
+# (interface, data, length) tuples drained from all the ready interfaces.
+def recv_batch(max_frames=MAX_BATCH_LEN):
+    global _batch_frames
+    max_frames = min(max_frames, MAX_BATCH_LEN)
+
+    frame_size = get_max_frame_len()
+    if _batch_frames is None:
+        _batch_frames = create_string_buffer(frame_size * MAX_BATCH_LEN)
+    # The frames may have been reordered by the fast path
+    for i in range(MAX_BATCH_LEN):
+        _batch_ptrs[i] = ctypes.addressof(_batch_frames) + i * frame_size
+
+    count = lib.recv_batch(_batch_ptrs, frame_size, _batch_ifaces, _batch_lengths, max_frames)
+
+    frames = []
+    for i in range(count):
+        length = _batch_lengths[i]
+        data = ctypes.string_at(_batch_ptrs[i], length)
+        frames.append((_batch_ifaces[i], data, length))
+
+    return frames
+
+# A pool of preallocated receive buffers. Frames are received directly into
+# the pool and handed out as read-only memoryviews, without any copy. A frame
+# stays valid (and its buffer is not reused) until it is given back with
+# release(), so it can be held while queued for egress. The buffers hold the
+# largest frame of any interface, unless frame_size is given.
+class FramePool:
+    def __init__(self, size=FRAME_POOL_SIZE, frame_size=None):
+        if frame_size is None:
+            frame_size = get_max_frame_len()
+        self.frame_size = frame_size
+        self.storage = bytearray(size * frame_size)
+        self.c_storage = (ctypes.c_char * len(self.storage)).from_buffer(self.storage)
+        self.base = ctypes.addressof(self.c_storage)
+        self.view = memoryview(self.storage).toreadonly()
+        self.free_slots = list(range(size))
+        # id(frame) -> (frame, slot); holding the frame keeps its id unique
+        self.in_use = {}
+        self.ptrs = (ctypes.c_void_p * MAX_BATCH_LEN)()
+
+    # Same as recv_batch, but the frames are memoryviews into the pool
+    def recv(self, max_frames=MAX_BATCH_LEN):
+        return self._recv(max_frames, None)
+
+    # Receives the frames queued on one interface, without blocking
+    def recv_from(self, interface, max_frames=MAX_BATCH_LEN):
+        return self._recv(max_frames, interface)
+
+    def _recv(self, max_frames, interface):
+        max_frames = min(max_frames, MAX_BATCH_LEN, len(self.free_slots))
+        if max_frames == 0:
+            raise RuntimeError("frame pool exhausted, frames are not released")
+
+        slots = self.free_slots[-max_frames:]
+        for i, slot in enumerate(slots):
+            self.ptrs[i] = self.base + slot * self.frame_size
+
+        if interface is None:
+            count = lib.recv_batch(self.ptrs, self.frame_size, _batch_ifaces, _batch_lengths, max_frames)
+        else:
+            count = lib.recv_batch_from_link(interface, self.ptrs, self.frame_size, _batch_lengths, max_frames)
+            for i in range(count):
+                _batch_ifaces[i] = interface
+
+        # The frames were written to the first count pointers, which the
+        # fast path may have reordered
+        slots = [(self.ptrs[i] - self.base) // self.frame_size for i in range(max_frames)]
+        del self.free_slots[-max_frames:]
+        self.free_slots.extend(slots[count:])
+
+        frames = []
+        for i in range(count):
+            start = slots[i] * self.frame_size
+            length = _batch_lengths[i]
+            frame = self.view[start:start + length]
+            self.in_use[id(frame)] = (frame, slots[i])
+            frames.append((_batch_ifaces[i], frame, length))
+
+        return frames
+
+    # Gives the buffer of a frame returned by recv back to the pool
+    def release(self, frame):
+        _, slot = self.in_use.pop(id(frame))
+        self.free_slots.append(slot)
+
+    # Gives back all the frames of a batch returned by recv
+    def release_batch(self, frames):
+        for _, frame, _ in frames:
+            self.release(frame)
+
+# Receives frames straight from the TPACKET_V3 rings mapped by
+# init(..., RX_BACKEND_RING). Each ring is exposed as a read-only memoryview
+# and frames are slices of it, so nothing is copied from the kernel. The frames
+# of a batch stay valid until release_batch, which must be called before the
+# next recv.
+class RxRing:
+    def __init__(self, num_interfaces):
+        self.rings = []
+        for i in range(num_interfaces):
+            base = ctypes.c_void_p()
+            size = ctypes.c_size_t()
+            assert(lib.get_rx_ring(i, ctypes.byref(base), ctypes.byref(size)) == 0)
+            view = ctypes.pythonapi.PyMemoryView_FromMemory(base, size.value, PyBUF_READ)
+            self.rings.append((base.value, view))
+        self.ptrs = (ctypes.c_void_p * MAX_BATCH_LEN)()
+
+    def recv(self, max_frames=MAX_BATCH_LEN):
+        max_frames = min(max_frames, MAX_BATCH_LEN)
+
+        count = lib.ring_recv_batch(self.ptrs, _batch_ifaces, _batch_lengths, max_frames)
+
+        return self._frames(count)
+
+    # Receives the frames ready in the ring of one interface, without blocking
+    def recv_from(self, interface, max_frames=MAX_BATCH_LEN):
+        max_frames = min(max_frames, MAX_BATCH_LEN)
+
+        count = lib.ring_recv_from_link(interface, self.ptrs, _batch_lengths, max_frames)
+        for i in range(count):
+            _batch_ifaces[i] = interface
+
+        return self._frames(count)
+
+    def _frames(self, count):
+        frames = []
+        for i in range(count):
+            interface = _batch_ifaces[i]
+            base, view = self.rings[interface]
+            start = self.ptrs[i] - base
+            length = _batch_lengths[i]
+            frames.append((interface, view[start:start + length], length))
+
+        return frames
+
+    def release_batch(self, frames):
+        lib.ring_release()
+
+# Receives an interface, a frame (bytes, bytearray or memoryview) and an
+# optional length. The frame is passed to the library by pointer, without
+# any copy. Returns the number of bytes sent or -errno on failure (-ENOBUFS
+# when the TX ring is full).
+def send_to_link(interface, buffer, length=None):
+    view = get_frame_buffer(buffer)
+    try:
+        if length is None or length > view.len:
+            length = view.len
+
+        return lib.send_to_link(interface, view.buf, length)
+    finally:
+        release_frame_buffer(view)
+
+# Sends a frame given as two fragments, head followed by tail, with a single
+# sendmsg. Pushing or popping a VLAN tag only needs a new head, the (possibly
+# large) tail is sent from where it is. Returns the number of bytes sent or
+# -errno on failure.
+def send_to_link_iov(interface, head, tail):
+    head_view = get_frame_buffer(head)
+    try:
+        tail_view = get_frame_buffer(tail)
+        try:
+            return lib.send_to_link_iov(interface, head_view.buf, head_view.len,
+                                        tail_view.buf, tail_view.len)
+        finally:
+            release_frame_buffer(tail_view)
+    finally:
+        release_frame_buffer(head_view)
+
+# Sends a list of (interface, frame) or (interface, head, tail) tuples with a
+# single call into the library. The fragments can be bytes, bytearrays or
+# memoryviews; they are passed by pointer, so no copy is made on the Python
+# side. Returns the number of frames sent. Frames too large for the MTU of
+# their interface are dropped and counted (get_link_stats); with
+# TX_BACKEND_RING, frames that found their ring full were dropped too.
+def send_batch(frames):
+    count = len(frames)
+    if count == 0:
+        return 0
+
+    c_ifaces = (ctypes.c_int * count)()
+    c_heads = (ctypes.c_void_p * count)()
+    c_head_lens = (ctypes.c_size_t * count)()
+    c_tails = (ctypes.c_void_p * count)()
+    c_tail_lens = (ctypes.c_size_t * count)()
+    views = []
+    try:
+        for i, frame in enumerate(frames):
+            c_ifaces[i] = frame[0]
+
+            view = get_frame_buffer(frame[1])
+            views.append(view)
+            c_heads[i] = view.buf
+            c_head_lens[i] = view.len
+
+            if len(frame) == 3:
+                view = get_frame_buffer(frame[2])
+                views.append(view)
+                c_tails[i] = view.buf
+                c_tail_lens[i] = view.len
+
+        return lib.send_batch(c_ifaces, c_heads, c_head_lens, c_tails, c_tail_lens, count)
+    finally:
+        for view in views:
+            release_frame_buffer(view)
 
 def get_switch_mac():
     # Create a buffer for the MAC address
@@ -70,7 +641,45 @@ def get_switch_mac():
     
     return bytes(mac_buffer)
 
+# Returns the counters of the egress queue of an interface as a dict:
+# enqueued, sent, dropped, errors, depth and max_depth. None without egress
+# queues.
+def get_egress_stats(interface):
+    stats = EgressStats()
+    if lib.get_egress_stats(interface, ctypes.byref(stats)) != 0:
+        return None
+    return {name: getattr(stats, name) for name, _ in EgressStats._fields_}
+
+# The MTU of an interface, read by init()
+def get_interface_mtu(interface):
+    return lib.get_interface_mtu(interface)
+
+# The size of the receive buffers: the largest MTU, plus the Ethernet header
+# and a VLAN tag
+def get_max_frame_len():
+    return lib.get_max_frame_len()
+
+# The frames of an interface dropped for their size: received larger than the
+# buffers (rx_oversize), or too large to be sent, VLAN tag included
+# (tx_oversize); and the receive errors of the interface (rx_errors), e.g.
+# while its link is down
+def get_link_stats(interface):
+    stats = LinkStats()
+    if lib.get_link_stats(interface, ctypes.byref(stats)) != 0:
+        return None
+    return {name: getattr(stats, name) for name, _ in LinkStats._fields_}
+
+# Returns the file descriptor of an interface's socket, so that an event loop
+# can wait on it (e.g. asyncio's loop.add_reader)
+def get_interface_fd(interface):
+    return lib.get_interface_fd(interface)
+
 # Returns the name of an interface, used for the VLAN subtask
 def get_interface_name(interface):
 
     return lib.get_interface_name(interface).decode('utf-8')
+
+# Whether the link of an interface is up: the interface is up and has a
+# carrier. Read with SIOCGIFFLAGS on the interface's own socket.
+def link_is_up(interface):
+    return lib.get_link_up(interface) == 1